@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# coding: utf8
+"""
+Time the dot-fill under the chords of a chord-heavy line.
+
+Compare filling one glyph at a time, as the renderer used to, with
+computing the number of glyphs and drawing them as one string; then time
+rendering the whole line. Usage:
+
+    python bench/dot_fill.py [REPEAT]
+
+This file is part of chordlab.
+"""
+
+import os
+import sys
+import timeit
+import logging
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+from reportlab.pdfgen.canvas import Canvas
+from reportlab.pdfbase.pdfmetrics import stringWidth
+
+from chordlib import chopro
+from chordlib.canvas import CanvasAdapter
+from chordlib.layout import fill_count
+from chordlib.pdf import PdfSongsRenderer
+
+# long chords over short syllables: a fill under almost every chord
+line = (u'[Cmaj7#11]Fl[Dm7b5/Ab]y [G13sus4]me [Ebdim7]to the '
+    u'[Am7add11]mo[D7#9b13]on, [Gmaj9/B]let me [Bbm6/Db]pla[F#m7b5]y')
+
+font = ('Helvetica', 12)
+fill = u'·'
+
+
+def fill_loop(textobj, end):
+    while textobj.getCursor()[0] < end:
+        textobj.textOut(fill)
+
+def fill_string(textobj, end):
+    x = textobj.getCursor()[0]
+    n = fill_count(x, end, stringWidth(fill, *font))
+    if n:
+        textobj.textOut(fill * n)
+
+
+def time_fill(func, repeat):
+    def run():
+        textobj = Canvas(os.devnull).beginText(0, 0)
+        textobj.setFont(*font)
+        for i in range(20):
+            func(textobj, textobj.getCursor()[0] + 60)
+    return min(timeit.repeat(run, number=repeat, repeat=5))
+
+
+def time_line(repeat):
+    token = chopro.Line(chopro.ChoProParser.chord_re.split(line))
+    def run():
+        r = PdfSongsRenderer(CanvasAdapter(os.devnull))
+        r.new_song('bench')
+        for i in range(100):
+            r.handle_token(token)
+    return min(timeit.repeat(run, number=repeat, repeat=5))
+
+
+def main():
+    logging.disable(logging.WARNING)
+    repeat = int(sys.argv[1]) if sys.argv[1:] else 100
+    print "fill, one glyph at a time: %.3fs" % time_fill(fill_loop, repeat)
+    print "fill, one string:          %.3fs" % time_fill(fill_string, repeat)
+    print "100 lines:                 %.3fs" % time_line(repeat // 10 or 1)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
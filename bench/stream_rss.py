@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Measure the peak memory of a songbook build against its number of pages.
+
+Render books of growing size with and without --stream and print the peak
+RSS of each build by its number of pages. Usage:
+
+    python bench/stream_rss.py [SONGS...]
+
+Each song is two pages long.
+
+This file is part of chordlab.
+"""
+
+import os
+import re
+import sys
+import shutil
+import tempfile
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+# a song filling two pages
+song = u"""{title: Song %(n)d}
+{subtitle: Benchmark}
+%(verses)s
+{soc}
+[G]Chorus line [D/F#]number %(n)d, [Em7]singing [Cmaj7]along
+[G]Chorus line [D/F#]number %(n)d, [Em7]singing [Cmaj7]along
+{eoc}
+"""
+
+verse = u"[C]Verse line [Am7]with some [Dm7]words and [G7sus4]chords %d"
+
+
+def write_songs(directory, count):
+    """Write `count` songs in a directory; return their file names."""
+    rv = []
+    for n in range(count):
+        fn = os.path.join(directory, 'song%05d.chopro' % n)
+        f = open(fn, 'w')
+        try:
+            verses = u'\n'.join(verse % i for i in range(40))
+            f.write((song % {'n': n, 'verses': verses}).encode('utf8'))
+        finally:
+            f.close()
+        rv.append(fn)
+    return rv
+
+
+def child(args):
+    """Build a book in this process and print the peak RSS in KB."""
+    import resource
+    import logging
+    from chordlib import script
+
+    logging.disable(logging.WARNING)
+    sys.argv = ['chordlab'] + args
+    script.main()
+    print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# the page objects in a PDF file
+_page_re = re.compile(r'/Type /Page\b(?!s)')
+
+def measure(songs, output, stream):
+    """Build a book in a new process; return its pages and the peak RSS."""
+    args = [sys.executable, os.path.abspath(__file__), '--child',
+        '-o', output]
+    if stream:
+        args.append('--stream')
+    out = subprocess.check_output(args + songs)
+
+    f = open(output, 'rb')
+    try:
+        pages = len(_page_re.findall(f.read()))
+    finally:
+        f.close()
+    return pages, int(out.split()[-1])
+
+def main():
+    if sys.argv[1:2] == ['--child']:
+        return child(sys.argv[2:])
+
+    sizes = map(int, sys.argv[1:]) or [100, 400, 1600]
+    directory = tempfile.mkdtemp(prefix='chordlab-bench-')
+    try:
+        songs = write_songs(directory, max(sizes))
+        output = os.path.join(directory, 'book.pdf')
+        print "%8s %12s %12s" % ('pages', 'default KB', '--stream KB')
+        for size in sizes:
+            pages, rss = measure(songs[:size], output, False)
+            pages2, rss2 = measure(songs[:size], output, True)
+            assert pages == pages2, (pages, pages2)
+            print "%8d %12d %12d" % (pages, rss, rss2)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Measure the memory used by each token of a parsed chopro input.
+
+Parse the files given, or a generated songbook, and print the size per
+token of the slotted tokens and of the same tokens as the objects with a
+`__dict__` and a list of parts used before. Usage:
+
+    python bench/token_size.py [FILE...]
+
+The sizes are computed with `sys.getsizeof()` following the references;
+the objects shared by more tokens, e.g. the chord symbols, are counted once.
+
+This file is part of chordlab.
+"""
+
+import os
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+from chordlib import chopro
+
+# a song with the usual mix of statements, lyrics and chords
+song = u"""{title: Song %(n)d}
+{subtitle: Benchmark}
+{define: Cmaj7 base-fret 1 frets x 3 2 0 0 0}
+%(verses)s
+{soc}
+[G]Chorus line [D/F#]number %(n)d, [Em7]singing [Cmaj7]along
+{eoc}
+{c: Repeat}
+"""
+
+verse = u"[C]Verse line [Am7]with some [Dm7]words and [G7sus4]chords %d"
+
+
+class DictToken(object):
+    """A token as it was before the slots: an object with an `arg`."""
+    def __init__(self, arg):
+        self.arg = arg
+
+
+def generate(count):
+    """Generate the tokens of `count` songs."""
+    parser = chopro.ChoProParser()
+    for n in range(count):
+        verses = u'\n'.join(verse % i for i in range(30))
+        text = song % {'n': n, 'verses': verses}
+        for token in parser.parse_file(text.splitlines()):
+            yield token
+
+
+def deep_size(obj, seen):
+    """Return the size of an object and of the objects it refers to."""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    rv = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        rv += sum(deep_size(x, seen) for x in obj)
+    elif isinstance(obj, dict):
+        rv += sum(deep_size(k, seen) + deep_size(v, seen)
+            for k, v in obj.iteritems())
+
+    d = getattr(obj, '__dict__', None)
+    if d is not None:
+        rv += deep_size(d, seen)
+    for cls in type(obj).__mro__:
+        for name in cls.__dict__.get('__slots__', ()):
+            if hasattr(obj, name):
+                rv += deep_size(getattr(obj, name), seen)
+
+    return rv
+
+
+def per_token(tokens):
+    seen = set()
+    return float(sum(deep_size(t, seen) for t in tokens)) / len(tokens)
+
+
+def main():
+    if sys.argv[1:]:
+        parser = chopro.ChoProParser()
+        tokens = [t for fn in sys.argv[1:] for t in parser.parse_file(fn)]
+    else:
+        tokens = list(generate(200))
+
+    print "%d tokens" % len(tokens)
+    print "%-10s %8.1f bytes/token" % ('dict', per_token(
+        [DictToken(t.arg) for t in tokens]))
+    print "%-10s %8.1f bytes/token" % ('slots', per_token(tokens))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,239 @@
+"""
+On-disk cache of parsed chopro files and rendered pages.
+
+This file is part of chordlab.
+"""
+
+import io
+import os
+import time
+import zlib
+import marshal
+import hashlib
+import tempfile
+
+from . import chopro
+
+import logging
+logger = logging.getLogger('chordlib.cache')
+
+# Bump to invalidate the entries written by previous versions
+format_version = 5
+
+# extensions of the entries files of all the caches, and of the voicings
+# files saved by `VoicingGenerator`
+entry_suffixes = ('.tok', '.pages', '.dat')
+
+# age in seconds of a temporary file left behind by an interrupted write
+stale_age = 3600
+
+
+def get_file_mode():
+    """Return the mode of a new file: 0666 less the umask.
+
+    `mkstemp()` creates files only readable by the user: the entries are
+    given this mode to be shared by the users of a cache directory.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0666 & ~umask
+
+
+class DiskCache(object):
+    """A directory of cache entries stored by key.
+
+    Entries are written atomically, so that more processes, also run by
+    different users, can share the same directory. When the entries of all
+    the caches in the directory, including the voicings files, grow beyond
+    `max_size` bytes, the least recently used ones are dropped by `evict()`.
+    """
+    # extension of the entries files
+    suffix = None
+
+    def __init__(self, directory, max_size=100 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # maybe created concurrently
+                if not os.path.isdir(directory):
+                    raise
+
+    def evict(self):
+        """Remove the least recently used entries above the size limit.
+
+        The entries of all the caches in the directory are counted together.
+        The temporary files older than `stale_age` are removed too.
+        """
+        now = time.time()
+        entries = []
+        for fn in os.listdir(self.directory):
+            if not fn.endswith(entry_suffixes + ('.tmp',)):
+                continue
+            path = os.path.join(self.directory, fn)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not fn.endswith('.tmp'):
+                entries.append((st.st_mtime, st.st_size, path))
+            elif st.st_mtime < now - stale_age:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        size = sum(e[1] for e in entries)
+        entries.sort()
+        for mtime, fsize, path in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # removed by someone else
+                pass
+            size -= fsize
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def _read(self, key):
+        """Return the data of an entry, None if missing or unreadable."""
+        path = self._get_path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+
+        try:
+            try:
+                data = marshal.loads(zlib.decompress(f.read()))
+            finally:
+                f.close()
+        except Exception, e:
+            logger.warn("bad cache entry %s: %s", path, e)
+            return None
+
+        # mark the entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return data
+
+    def _write(self, key, data):
+        data = zlib.compress(marshal.dumps(data))
+
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            os.chmod(tmp, get_file_mode())
+            os.rename(tmp, self._get_path(key))
+        except OSError, e:
+            logger.warn("can't write cache entry: %s", e)
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+class TokenCache(DiskCache):
+    """Store the tokens parsed from chopro files in a directory.
+
+    Entries are keyed by the file content, the parser configuration and
+    version, so a changed file is parsed again. The warnings emitted
+    parsing a file are stored with its tokens and emitted again when the
+    tokens are read from the cache.
+    """
+    suffix = '.tok'
+
+    def parse_file(self, parser, fn):
+        """Return the list of tokens in a file, parsing it if not cached."""
+        f = open(fn, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        key = self._get_key(parser, data)
+        entry = self._load(key)
+        if entry is not None:
+            warnings, tokens = entry
+            for level, msg in warnings:
+                chopro.logger.log(level, "%s", msg)
+            return tokens
+
+        collector = WarningsCollector()
+        chopro.logger.addHandler(collector)
+        try:
+            tokens = list(parser.parse_file(
+                parser.decode(io.BufferedReader(io.BytesIO(data)))))
+        finally:
+            chopro.logger.removeHandler(collector)
+
+        self._save(key, collector.records, tokens)
+        return tokens
+
+    def _get_key(self, parser, data):
+        h = hashlib.sha1()
+        h.update('%s:%s:%s:%s\0' % (format_version, parser.version,
+            marshal.version, parser.default_encoding))
+        h.update(data)
+        return h.hexdigest()
+
+    def _load(self, key):
+        """Return the (warnings, tokens) of an entry, None if missing."""
+        data = self._read(key)
+        if data is None:
+            return None
+
+        try:
+            warnings, tokens = data
+            return warnings, [chopro.token_classes[kind].from_state(state)
+                for kind, state in tokens]
+        except Exception, e:
+            logger.warn("bad cache entry %s: %s", self._get_path(key), e)
+            return None
+
+    def _save(self, key, warnings, tokens):
+        self._write(key,
+            (warnings, [(t.kind, t.get_state()) for t in tokens]))
+
+
+class WarningsCollector(logging.Handler):
+    """A logging handler storing the (level, message) of the warnings."""
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+
+class PageCache(DiskCache):
+    """Store the pages rendered for the songs in a directory.
+
+    Entries are keyed by the tokens of a song and by everything else its
+    pages depend on, as returned by `PdfSongsRenderer.get_song_state()`.
+    """
+    suffix = '.pages'
+
+    def get_key(self, tokens, state):
+        h = hashlib.sha1()
+        h.update(marshal.dumps((format_version, marshal.version, state)))
+        h.update(marshal.dumps([(t.kind, t.get_state()) for t in tokens]))
+        return h.hexdigest()
+
+    def load(self, key):
+        """Return the pages stored for a key, None if not found."""
+        return self._read(key)
+
+    def save(self, key, pages):
+        self._write(key, pages)
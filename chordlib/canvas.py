@@ -4,18 +4,36 @@ Customized reportlab canvas
 This file is part of chordlab.
 """
 
+import reportlab
 from reportlab.pdfgen import canvas
+from reportlab.pdfbase import pdfdoc
 from reportlab.lib.pagesizes import A4
 
 from chordlib import consts
 
+import logging
+logger = logging.getLogger('chordlib.canvas')
+
 class CanvasAdapter(canvas.Canvas):
     "My convenience adapter for the reportlab canvas."
 
     def __init__(self, filename, pagesize=A4, margin=50, showfilenames=False,
-                 title=None, author=None):
+                 title=None, author=None, streaming=False):
         canvas.Canvas.__init__(self, filename, pagesize=pagesize)
 
+        if streaming and not StreamingDocument.can_replace(self._doc):
+            logger.warn("streaming not supported by reportlab %s: "
+                "the document is written at the end", reportlab.Version)
+            streaming = False
+
+        if streaming:
+            # replace the document before anything is added to it
+            doc = self._doc
+            self._doc = StreamingDocument(filename,
+                compression=doc.compression, invariant=doc.invariant,
+                pdfVersion=doc._pdfVersion)
+            self._make_preamble()
+
         self.setTitle(title or 'Songbook')
 
         # reportlab doesn't provide a nicer interface to this (yet)
@@ -28,6 +46,9 @@ class CanvasAdapter(canvas.Canvas):
         self.margin = margin
         self.showfilenames = showfilenames
 
+        # names of the forms drawn in the document, by the user's key
+        self.forms = {}
+
     def _guess_author(self):
         try:
             import pwd, socket, os
@@ -58,6 +79,28 @@ class CanvasAdapter(canvas.Canvas):
         "Get top end of drawable area"
         return self.bottom
 
+    def get_code_size(self):
+        "Return the number of operations drawn on the current page"
+        return len(self._code)
+
+    def get_page_code(self, start=0):
+        "Return the operations of the current page from `start` and the forms used"
+        return self._code[start:], list(self._formsinuse)
+
+    def add_page_code(self, code, forms):
+        "Append operations using some forms to the current page"
+        self._code.extend(code)
+        self._formsinuse.extend(forms)
+
+    def get_font_names(self):
+        "Return a map from the internal names of the fonts used to their names"
+        return dict((v.lstrip('/'), k)
+            for k, v in self._doc.fontMapping.iteritems())
+
+    def get_internal_font_name(self, fontname):
+        "Return the name of a font in the operations, adding it if needed"
+        return self._doc.getInternalFontName(fontname).lstrip('/')
+
     def draw_aligned_string(self, align, ypos, text):
         if align == 'left':
             meth = self.drawString
@@ -72,3 +115,125 @@ class CanvasAdapter(canvas.Canvas):
             raise ValueError('bad align: %s' % align)
 
         meth(xpos, ypos, text)
+
+
+class StreamingDocument(pdfdoc.PDFDocument):
+    """A PDF document writing the pages to the file as soon as they are added.
+
+    Only the cross-reference data and the objects shared by the pages
+    (fonts, forms, the page tree...) are kept in memory until the document
+    is saved, so the memory used doesn't grow with the number of pages.
+
+    The class relies on reportlab internals, checked by `can_replace()`.
+    """
+    # the internals of the document and the PDF file used
+    _doc_attrs = ('idToObject', 'idToOffset', 'numberToId', 'objectcounter',
+        'Pages', 'Catalog', 'info', 'encrypt', 'compression', 'invariant',
+        '_pdfVersion', 'thisPageName', 'Reference', 'ID', 'GetPDFData')
+    _file_attrs = ('strings', 'add')
+    _pdfdoc_names = ('PDFFile', 'PDFIndirectObject', 'PDFObjectReference',
+        'PDFCrossReferenceTable', 'PDFTrailer')
+
+    @classmethod
+    def can_replace(cls, doc):
+        """Tell if the internals used are found in a reportlab document."""
+        if not all(hasattr(pdfdoc, n) for n in cls._pdfdoc_names):
+            return False
+        if not all(hasattr(doc, n) for n in cls._doc_attrs):
+            return False
+        if not hasattr(doc.Pages, 'pages'):
+            return False
+        try:
+            f = pdfdoc.PDFFile(doc._pdfVersion)
+        except TypeError:
+            return False
+        return all(hasattr(f, n) for n in cls._file_attrs)
+
+    def __init__(self, filename, **kwargs):
+        pdfdoc.PDFDocument.__init__(self, filename=filename, **kwargs)
+        self._filename = filename
+        self._file = None
+        self._output = None
+        self._header_version = None
+
+    def addPage(self, page):
+        name = self.thisPageName()
+        pdfdoc.PDFDocument.addPage(self, page)
+
+        # the page tree only needs the reference to the page
+        self.Pages.pages[-1] = pdfdoc.PDFObjectReference(name)
+        self._write_object(name)
+
+    def SaveToFile(self, filename, canvas):
+        self.GetPDFData(canvas)
+
+    def format(self):
+        """Write the objects not written yet, then the xref and trailer."""
+        self.encrypt.prepare(self)
+        cat = self.Reference(self.Catalog)
+        info = self.Reference(self.info)
+        encryptref = None
+        encryptinfo = self.encrypt.info()
+        if encryptinfo:
+            encryptref = self.Reference(encryptinfo)
+
+        # objects may be added while writing the others
+        counter = 1
+        while counter in self.numberToId:
+            oid = self.numberToId[counter]
+            if oid not in self.idToOffset:
+                self._write_object(oid)
+            counter += 1
+
+        ids = [self.numberToId[n] for n in range(1, counter)]
+        xref = pdfdoc.PDFCrossReferenceTable()
+        xref.addsection(0, ids)
+        f = self._get_file()
+        xrefoffset = f.add(xref.format(self))
+        trailer = pdfdoc.PDFTrailer(startxref=xrefoffset, Size=counter,
+            Root=cat, Info=info, Encrypt=encryptref, ID=self.ID())
+        f.add(trailer.format(self))
+
+        if self._output is not None:
+            if self._pdfVersion != self._header_version:
+                # raised after writing the header: it has the same length
+                self._output.seek(0)
+                self._output.write(self._get_header())
+            self._output.close()
+        return ''
+
+    def _write_object(self, oid):
+        """Write an object and the objects added by formatting it.
+
+        The page tree can still change: it is only written at the end.
+        """
+        f = self._get_file()
+        last = self.objectcounter
+        obj = self.idToObject[oid]
+        self.idToOffset[oid] = f.add(
+            pdfdoc.PDFIndirectObject(oid, obj).format(self))
+        # keep the name registered, but not the object
+        self.idToObject[oid] = None
+
+        for n in range(last + 1, self.objectcounter + 1):
+            oid = self.numberToId[n]
+            if self.idToObject[oid] is not self.Pages \
+                    and oid not in self.idToOffset:
+                self._write_object(oid)
+
+    def _get_file(self):
+        if self._file is None:
+            if hasattr(self._filename, 'write'):
+                out = self._filename
+            else:
+                out = self._output = open(self._filename, 'wb')
+            f = self._file = pdfdoc.PDFFile(self._pdfVersion)
+            self._header_version = self._pdfVersion
+            out.write(''.join(f.strings))
+            f.strings = None
+            f.write = out.write
+
+        return self._file
+
+    def _get_header(self):
+        return ''.join(pdfdoc.PDFFile(self._pdfVersion).strings)
@@ -4,13 +4,21 @@ chopro format parser
 This file is part of chordlab.
 """
 
+import io
 import re
 import codecs
 
+from .chords import chord_symbol
+
 import logging
 logger = logging.getLogger('chordlib.chopro')
 
 class Token(object):
+    __slots__ = ('arg',)
+
+    # small integer identifying the token class, set below
+    kind = None
+
     def __init__(self, arg):
         self.arg = self.parse_arg(arg)
 
@@ -20,7 +28,23 @@ class Token(object):
     def parse_arg(self, arg):
         return arg
 
+    def get_state(self):
+        """Return the token content as a marshallable object."""
+        return self.arg
+
+    @classmethod
+    def from_state(cls, state):
+        """Create a token from the result of `get_state()`."""
+        rv = cls.__new__(cls)
+        rv.arg = state
+        return rv
+
+    def __reduce__(self):
+        return (_restore_token, (self.kind, self.get_state()))
+
 class NoArg(object):
+    __slots__ = ()
+
     def parse_arg(self, arg):
         if arg:
             logger.warn('statement %s expects no arg, got %s',
@@ -28,6 +52,8 @@ class NoArg(object):
         return None
 
 class IntArg(object):
+    __slots__ = ()
+
     def parse_arg(self, arg):
         try:
             return int(arg)
@@ -37,26 +63,84 @@ class IntArg(object):
                 % (self.__class__.__name__, arg))
 
 class ListArg(object):
+    __slots__ = ()
+
     def parse_arg(self, arg):
         return arg.split()
 
-class Title(Token): pass
-class SubTitle(Token): pass
-class Comment(Token): pass
-class StartOfChorus(NoArg, Token): pass
-class EndOfChorus(NoArg, Token): pass
-class StartOfTab(NoArg, Token): pass
-class EndOfTab(NoArg, Token): pass
-class Columns(IntArg, Token): pass
-class ColumnBreak(NoArg, Token): pass
-class NewPage(NoArg, Token): pass
-class NewSong(NoArg, Token): pass
-class Define(ListArg, Token): pass
-class NoGrid(NoArg, Token): pass
-class Blank(NoArg, Token): pass
-class SourceComment(Token): pass
-class TabLine(Token): pass
-class Line(Token): pass
+class Title(Token): __slots__ = ()
+class SubTitle(Token): __slots__ = ()
+class Comment(Token): __slots__ = ()
+class StartOfChorus(NoArg, Token): __slots__ = ()
+class EndOfChorus(NoArg, Token): __slots__ = ()
+class StartOfTab(NoArg, Token): __slots__ = ()
+class EndOfTab(NoArg, Token): __slots__ = ()
+class Columns(IntArg, Token): __slots__ = ()
+class ColumnBreak(NoArg, Token): __slots__ = ()
+class NewPage(NoArg, Token): __slots__ = ()
+class NewSong(NoArg, Token): __slots__ = ()
+class Define(ListArg, Token): __slots__ = ()
+class NoGrid(NoArg, Token): __slots__ = ()
+class Blank(NoArg, Token): __slots__ = ()
+class SourceComment(Token): __slots__ = ()
+class TabLine(Token): __slots__ = ()
+
+class FontScale(Token):
+    """Scale the text of the rest of the song by a factor.
+
+    There is no statement for it: it is added by the --fit option.
+    """
+    __slots__ = ()
+
+class Line(Token):
+    """A line of lyrics and chords.
+
+    `arg` is the list of alternating lyrics and chords parts, starting with
+    lyrics. The token only stores the parts joined together and the offsets
+    where each part ends. `chords` is the tuple of the `ChordSymbol` of the
+    chords parts.
+    """
+    __slots__ = ('text', 'ends', 'chords')
+
+    def __init__(self, parts):
+        self.text = u''.join(parts)
+        ends = []
+        end = 0
+        for part in parts:
+            end += len(part)
+            ends.append(end)
+        self.ends = tuple(ends)
+        self.chords = tuple(map(chord_symbol, parts[1::2]))
+
+    @property
+    def arg(self):
+        text = self.text
+        rv = []
+        start = 0
+        for end in self.ends:
+            rv.append(text[start:end])
+            start = end
+        return rv
+
+    def get_state(self):
+        return (self.text, self.ends)
+
+    @classmethod
+    def from_state(cls, state):
+        rv = cls.__new__(cls)
+        rv.text, rv.ends = state
+        rv.chords = tuple(map(chord_symbol, rv.arg[1::2]))
+        return rv
+
+
+token_classes = [Title, SubTitle, Comment, StartOfChorus, EndOfChorus,
+    StartOfTab, EndOfTab, Columns, ColumnBreak, NewPage, NewSong, Define,
+    NoGrid, Blank, SourceComment, TabLine, Line, FontScale]
+for i, cls in enumerate(token_classes):
+    cls.kind = i
+
+def _restore_token(kind, state):
+    return token_classes[kind].from_state(state)
 
 
 statements = {
@@ -100,25 +184,53 @@ class ChoProParser(object):
     class ParseError(Exception):
         pass
 
+    # Bump when the tokens emitted change, to invalidate cached results
+    version = 2
+
+    coding_re = re.compile(r'-\*- +(en)?coding: (?P<c>[a-z0-9_-]+) +-\*-')
+    stmt_re = re.compile('\s*{([a-z_]+)(:? *(.*))?}\s*', re.I)
+    chord_re = re.compile('\[([^]]*)\]')
+
+    # longest first, as utf-16 boms are prefixes of the utf-32 ones
+    boms = [
+        (codecs.BOM_UTF32_LE, 'utf-32-le'),
+        (codecs.BOM_UTF32_BE, 'utf-32-be'),
+        (codecs.BOM_UTF8, 'utf-8'),
+        (codecs.BOM_UTF16_LE, 'utf-16-le'),
+        (codecs.BOM_UTF16_BE, 'utf-16-be'),
+    ]
+
     def __init__(self, default_encoding='utf-8'):
         self.default_encoding = default_encoding
 
     def open_file(self, fn):
-        # Check the two first lines for an encoding mark!
-        f = open(fn)
-        coding = re.search(r'-\*- +(en)?coding: (?P<c>[a-z0-9_-]+) +-\*-', 
-                           f.readline() + f.readline())
-        f.close()
-        enc = coding.group('c') if coding else self.default_encoding
-        return codecs.open(fn, 'r', enc)
+        return self.decode(io.open(fn, 'rb'))
+
+    def decode(self, f):
+        """Return a text stream reading from a buffered binary file.
+
+        The encoding is detected from a BOM or from a coding mark in the
+        first two lines of the file.
+        """
+        head = f.peek(4096)
+        for bom, enc in self.boms:
+            if head.startswith(bom):
+                f.read(len(bom))
+                break
+        else:
+            # Check the two first lines for an encoding mark!
+            coding = self.coding_re.search(
+                '\n'.join(head.split('\n', 2)[:2]))
+            enc = coding.group('c') if coding else self.default_encoding
 
+        return io.TextIOWrapper(f, encoding=enc)
 
     def parse_file(self, f):
         if isinstance(f, basestring):
             f = self.open_file(f)
 
-        stmt_re = re.compile('\s*{([a-z_]+)(:? *(.*))?}\s*', re.I)
-        chord_re = re.compile('\[([^]]*)\]')
+        stmt_re = self.stmt_re
+        chord_re = self.chord_re
         tabmode = False
 
         for line in f:
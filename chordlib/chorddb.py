@@ -0,0 +1,190 @@
+"""
+Compact on-disk database of chord voicings.
+
+The database file contains, after a header:
+
+- an index of the chord names, sorted, with fixed-width entries pointing
+  to the name and to the voicings of the chord;
+- the voicings, as fixed-width arrays of bytes: base fret, then a fret
+  per string (255 for a muted string);
+- the pool of the names, encoded in utf-8.
+
+The file is memory-mapped and looked up by binary search, so only the
+pages of the chords used are read.
+
+Run this module to rebuild the databases from the `guitar` and `ukulele`
+chord tables.
+
+This file is part of chordlab.
+"""
+
+import os
+import mmap
+import struct
+import hashlib
+
+from .error import ChordLibError
+
+magic = 'CLDB'
+format_version = 1
+
+header = struct.Struct('<4sBBxxII')   # magic, version, nstrings, nnames, nvoicings
+entry = struct.Struct('<IHHI')        # name offset, name len, nvoicings, first
+
+muted = 255
+
+def get_path(instrument):
+    """Return the path of the database file of an instrument."""
+    return os.path.join(os.path.dirname(__file__), 'data',
+        instrument + '.chords')
+
+
+class ChordDatabase(object):
+    """Read-only mapping from chord names to voicings in a database file.
+
+    Lookup returns the first voicing of a chord; `get_all()` returns all of
+    them.
+    """
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        try:
+            (mag, ver, self.nstrings, self._nnames, self._nvoicings) \
+                = header.unpack_from(self._map, 0)
+        except struct.error:
+            mag = ver = None
+        if mag != magic or ver != format_version:
+            raise ChordLibError("bad chords database: %s" % path)
+
+        self._index = header.size
+        self._voicings = self._index + entry.size * self._nnames
+        self._names = self._voicings + (self.nstrings + 1) * self._nvoicings
+        self._cache = {}
+
+    @classmethod
+    def open(cls, instrument):
+        """Return the database of an instrument, None if there is none."""
+        path = get_path(instrument)
+        if os.path.exists(path):
+            return cls(path)
+
+    def get_digest(self):
+        """Return a string identifying the content of the database."""
+        return hashlib.sha1(self._map[:]).hexdigest()
+
+    def get_all(self, name):
+        """Return the list of the voicings of a chord (maybe empty)."""
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+
+        if isinstance(name, unicode):
+            key = name.encode('utf8')
+        else:
+            key = name
+
+        lo, hi = 0, self._nnames
+        rv = []
+        while lo < hi:
+            mid = (lo + hi) // 2
+            noff, nlen, nv, first = entry.unpack_from(
+                self._map, self._index + mid * entry.size)
+            mname = self._map[self._names + noff:self._names + noff + nlen]
+            if mname < key:
+                lo = mid + 1
+            elif mname > key:
+                hi = mid
+            else:
+                rv = [self._get_voicing(first + i) for i in range(nv)]
+                break
+
+        self._cache[name] = rv
+        return rv
+
+    def get(self, name, default=None):
+        rv = self.get_all(name)
+        return rv[0] if rv else default
+
+    def __getitem__(self, name):
+        rv = self.get_all(name)
+        if not rv:
+            raise KeyError(name)
+        return rv[0]
+
+    def __contains__(self, name):
+        return bool(self.get_all(name))
+
+    def __len__(self):
+        return self._nnames
+
+    def keys(self):
+        rv = []
+        for i in range(self._nnames):
+            noff, nlen, nv, first = entry.unpack_from(
+                self._map, self._index + i * entry.size)
+            rv.append(self._map[self._names + noff:self._names + noff + nlen]
+                .decode('utf8'))
+        return rv
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def iteritems(self):
+        for name in self.keys():
+            yield name, self[name]
+
+    def _get_voicing(self, i):
+        size = self.nstrings + 1
+        off = self._voicings + i * size
+        data = map(ord, self._map[off:off + size])
+        return [data[0]] + [f if f != muted else None for f in data[1:]]
+
+
+def write_database(path, chords):
+    """Write a database file from a map name -> list of voicings."""
+    nstrings = None
+    names = sorted((n.encode('utf8') if isinstance(n, unicode) else n, v)
+        for n, v in chords.iteritems())
+
+    index = []
+    voicings = []
+    pool = []
+    pool_size = 0
+    for name, vs in names:
+        index.append(entry.pack(pool_size, len(name), len(vs), len(voicings)))
+        pool.append(name)
+        pool_size += len(name)
+        for v in vs:
+            if nstrings is None:
+                nstrings = len(v) - 1
+            elif len(v) - 1 != nstrings:
+                raise ChordLibError("bad number of strings in chord %s: %s"
+                    % (name, v))
+            voicings.append(''.join(
+                chr(muted if f is None else f) for f in v))
+
+    f = open(path, 'wb')
+    try:
+        f.write(header.pack(magic, format_version, nstrings or 0,
+            len(index), len(voicings)))
+        f.write(''.join(index))
+        f.write(''.join(voicings))
+        f.write(''.join(pool))
+    finally:
+        f.close()
+
+
+def main():
+    from . import guitar, ukulele
+    for instrument, module in (('guitar', guitar), ('ukulele', ukulele)):
+        write_database(get_path(instrument),
+            dict((n, [v]) for n, v in module.knownchords.iteritems()))
+
+if __name__ == '__main__':
+    main()
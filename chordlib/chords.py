@@ -0,0 +1,187 @@
+# coding: utf8
+"""
+Chord names parsing.
+
+This file is part of chordlab.
+"""
+
+import re
+
+# chord names not shown in the chord grid
+no_chords = frozenset(['N.C.', '%', '-', ''])
+
+_parens_re = re.compile(r'\s*\(.*\)')
+_slashes_re = re.compile(r'(\s*/\s*)*$')
+
+_normalized = {}
+_normalized_max = 10000
+
+def normalize_chord(chord):
+    """Return a chord name stripped of (parens) and trailing slashes.
+
+    Results are cached; the cache is emptied when it grows too large.
+    """
+    try:
+        return _normalized[chord]
+    except KeyError:
+        pass
+
+    rv = _parens_re.sub('', chord)      # strip (parens)
+    rv = _slashes_re.sub('', rv)        # strip trailing / / /
+    if len(_normalized) >= _normalized_max:
+        _normalized.clear()
+    _normalized[chord] = rv
+    return rv
+
+
+_chord_re = re.compile(r"""
+    ^(?P<lead> \s*)
+    (?P<root> [A-H])
+    (?P<accidental> [#b]?)
+    (?P<quality> min|m(?!aj|a\d)|dim|aug|\+)?
+    (?P<extensions> .*?)
+    (?:/(?P<bass> [A-H][#b]?))?
+    (?P<trailer> [\s/]*(?:\(.*\))?[\s/]*)$
+    """, re.VERBOSE)
+
+class ChordSymbol(object):
+    """A chord name parsed into its components.
+
+    Symbols are interned: use `chord_symbol()` to get the instance for a
+    name, so that symbols can be compared and hashed by identity.
+
+    For names that don't look like a chord (e.g. 'N.C.' or '%') `root` is
+    None. `lead` and `trailer` are the text around the chord, e.g. the
+    spaces and the ' (x2)' of ' D/F# (x2)'. `key` is the normalized name
+    used to look up the chord diagrams, `canonical` is shared by all the
+    spellings of the same chord.
+    """
+    __slots__ = ('name', 'lead', 'root', 'accidental', 'quality',
+        'extensions', 'bass', 'trailer', 'key', '_canonical')
+
+    def __init__(self, name):
+        self.name = name
+        self.key = normalize_chord(name)
+        m = _chord_re.match(name)
+        if m is not None:
+            self.lead = m.group('lead')
+            self.root = m.group('root')
+            self.accidental = m.group('accidental')
+            self.quality = m.group('quality') or ''
+            self.extensions = m.group('extensions')
+            self.bass = m.group('bass')
+            self.trailer = m.group('trailer')
+        else:
+            self.lead = self.root = self.accidental = self.quality = None
+            self.extensions = self.bass = self.trailer = None
+
+    def __repr__(self):
+        return "ChordSymbol(%r)" % self.name
+
+    def __reduce__(self):
+        return (chord_symbol, (self.name,))
+
+    @property
+    def note(self):
+        """The root note with its accidental, e.g. 'C#'."""
+        if self.root is not None:
+            return self.root + self.accidental
+
+    @property
+    def canonical(self):
+        """A key equal for the enharmonic spellings of the chord, or None.
+
+        E.g. 'C#maj7', 'DbM7' and 'DbΔ' have the same key, so do 'B7' and
+        'H7'.
+        """
+        try:
+            return self._canonical
+        except AttributeError:
+            rv = self._canonical = _get_canonical(self.key)
+            return rv
+
+
+_symbols = {}
+
+def chord_symbol(name):
+    """Return the interned `ChordSymbol` for a chord name."""
+    try:
+        return _symbols[name]
+    except KeyError:
+        rv = _symbols[name] = ChordSymbol(name)
+        return rv
+
+
+class ChordIndex(object):
+    """Find the chords of a table by any spelling of their name.
+
+    The index is built once from the table names: a name missing from the
+    table is looked up by its `ChordSymbol.canonical` key.
+    """
+    def __init__(self, names=()):
+        self._names = {}
+        for name in sorted(names):
+            self.add(name)
+
+    def add(self, name):
+        """Add a name of the table to the index.
+
+        If more names have the same key, the first one added is used.
+        """
+        canonical = chord_symbol(name).canonical
+        if canonical is not None:
+            self._names.setdefault(canonical, name)
+
+    def lookup(self, table, name, default=None):
+        """Return the entry of a chord in a table, by any spelling."""
+        try:
+            return table[name]
+        except KeyError:
+            pass
+
+        tname = self._names.get(chord_symbol(name).canonical)
+        if tname is not None:
+            return table.get(tname, default)
+
+        return default
+
+
+sharp_names = 'A A# B C C# D D# E F F# G G#'.split()
+flat_names = 'A Bb B C Db D Eb E F Gb G Ab'.split()
+
+# pitch class of the notes, A = 0; H is the German B
+positions = {}
+for i, n in enumerate(sharp_names):
+    if len(n) == 1:
+        positions[n] = i
+        positions[n + '#'] = (i + 1) % 12
+        positions[n + 'b'] = (i - 1) % 12
+positions['H'] = positions['B']
+positions['H#'] = positions['B#']
+positions['Hb'] = positions['Bb']
+
+_qualities = {'min': 'm', '+': 'aug'}
+
+# major chords extensions spelled M7, ma7, j7, Δ7...
+_maj_re = re.compile(u'^(?:M|ma|maj|j|\u0394)(?=\\d)')
+
+_suffixes = {
+    'M': '', 'maj': '', u'\u0394': 'maj7', u'm\u0394': 'mmaj7',
+    'sus': 'sus4', '7sus': '7sus4',
+}
+
+def _get_canonical(name):
+    m = _chord_re.match(name)
+    if m is None:
+        return None
+
+    quality = m.group('quality') or ''
+    extensions = _maj_re.sub('maj', m.group('extensions'))
+    suffix = _qualities.get(quality, quality) + extensions
+    suffix = _suffixes.get(suffix, suffix)
+
+    bass = m.group('bass')
+    if bass is not None:
+        bass = positions[bass]
+
+    return (positions[m.group('root') + m.group('accidental')], suffix, bass)
@@ -0,0 +1,224 @@
+"""
+Choice of the columns and the font scale fitting the songs in fewer pages.
+
+This file is part of chordlab.
+"""
+
+from . import chopro
+from .chords import ChordSymbol, chord_symbol, no_chords
+from .error import ChordLibError
+from .layout import SongsLayout, ChordGrid
+
+import logging
+logger = logging.getLogger('chordlib.fit')
+
+
+class PageCounter(SongsLayout):
+    """A layout only counting the pages of the songs.
+
+    The boxes are dropped: only the vertical flow of the song is computed,
+    including the rows of the wrapped lines, so `pageno` is the same as in
+    the rendered document. `overlaps` is set if the chord diagrams overlap
+    the text of a column on the last page of a song.
+    """
+    overlaps = False
+
+    def new_song(self, filename):
+        super(PageCounter, self).new_song(filename)
+        self.overlaps = False
+
+    def new_page(self):
+        super(PageCounter, self).new_page()
+        # (left, lowest y) of the columns completed on the page
+        self.columns = []
+        self.lowest = self.ypos
+
+    def column_break(self):
+        columns = self.columns + [(self.colleft, self.lowest)]
+        pageno = self.pageno
+        super(PageCounter, self).column_break()
+        if self.pageno == pageno:
+            self.columns = columns
+        self.lowest = self.ypos
+
+    def handle_token(self, token):
+        super(PageCounter, self).handle_token(token)
+        if self.ypos < self.lowest:
+            self.lowest = self.ypos
+
+    def add_page(self, page):
+        pass
+
+    def add_box(self, box):
+        if isinstance(box, ChordGrid) and self._overlaps(box):
+            self.overlaps = True
+
+    def _overlaps(self, grid):
+        """Tell if a chord grid overlaps the text on the page."""
+        columns = self.columns + [(self.colleft, self.lowest)]
+        for x, y, cname, chord in grid.diagrams:
+            left = (x - 12) * grid.scale
+            right = (x + 32) * grid.scale
+            top = (y + 48) * grid.scale
+            for colleft, lowest in columns:
+                colright = min(colleft + self.colw, self.page.right)
+                if top > lowest and left < colright and right > colleft:
+                    return True
+        return False
+
+    def define_chord(self, name, args):
+        # bad definitions are reported by the real renderer
+        if args[0] == 'base-fret' and args[2] == 'frets':
+            super(PageCounter, self).define_chord(name, args)
+
+    def use_chord(self, chord):
+        # unknown chords are reported by the real renderer
+        if not isinstance(chord, ChordSymbol):
+            chord = chord_symbol(chord)
+        if chord.key not in no_chords:
+            self.usedchords[chord.key] = True
+
+
+class SongFitter(object):
+    """Choose the number of columns and the font scale of the songs.
+
+    A song is laid out with up to `max_columns` columns and with its text
+    scaled between `min_scale` and 1 in steps of `step`. The layout with
+    the fewest pages wins; on equal pages the largest scale, then the
+    fewest columns.
+
+    The pages of a layout don't decrease growing the scale, so the largest
+    scale fitting in a number of pages is found by bisection. The pages
+    are counted by a `PageCounter` and memoized while fitting a song.
+    """
+    def __init__(self, stylesheet, pagesize, max_columns=3, min_scale=0.7,
+            step=0.05):
+        self.stylesheet = stylesheet
+        self.pagesize = pagesize
+        self.max_columns = max_columns
+        self.disable_compact = False
+        self.knownchords = None
+
+        if not 0 < min_scale <= 1:
+            raise ChordLibError("bad minimum scale: %s" % min_scale)
+        n = int(round((1.0 - min_scale) / step))
+        self.scales = [round(1.0 - i * step, 4) for i in range(n, -1, -1)]
+
+    def fit(self, fn, tokens):
+        """Generate the tokens of a file with the best columns and scale.
+
+        Every song in the file, as separated by {new_song}, is fitted
+        independently. The {columns} statements in the songs are replaced,
+        unless the song is already on the fewest pages.
+        """
+        song = []
+        for token in tokens:
+            if isinstance(token, chopro.NewSong):
+                for t in self.fit_song(fn, song):
+                    yield t
+                yield token
+                song = []
+            else:
+                song.append(token)
+
+        for t in self.fit_song(fn, song):
+            yield t
+
+    def fit_song(self, fn, tokens):
+        """Return the tokens of a song with the best columns and scale."""
+        orig = self.count_pages(tokens)
+        if orig <= 1:
+            return tokens
+
+        bare = [t for t in tokens if not isinstance(t, chopro.Columns)]
+        columns, scale, pages = self.choose(bare)
+        if orig <= pages:
+            return tokens
+
+        logger.info("%s: fitted in %d pages with %d columns at %d%%",
+            fn, pages, columns, round(scale * 100))
+        return apply_fit(bare, columns, scale)
+
+    def choose(self, tokens):
+        """Return the best (columns, scale, pages) for the tokens of a song."""
+        # (columns, scale index) -> pages
+        memo = {}
+        allcols = range(1, self.max_columns + 1)
+
+        # the fewest pages are found with the smallest scale
+        pages = min(self._count(tokens, memo, c, 0) for c in allcols)
+
+        best = None
+        for c in allcols:
+            if self._count(tokens, memo, c, 0) > pages:
+                continue
+            i = self._largest_scale(tokens, memo, c, pages)
+            if best is None or i > best[1]:
+                best = (c, i)
+
+        return best[0], self.scales[best[1]], pages
+
+    def _largest_scale(self, tokens, memo, columns, pages):
+        """Return the index of the largest scale fitting in some pages.
+
+        The smallest scale is known to fit.
+        """
+        lo, hi = 0, len(self.scales) - 1
+        if self._count(tokens, memo, columns, hi) <= pages:
+            return hi
+
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self._count(tokens, memo, columns, mid) <= pages:
+                lo = mid
+            else:
+                hi = mid
+
+        return lo
+
+    def _count(self, tokens, memo, columns, i):
+        """Return the pages of a song in a layout."""
+        key = (columns, i)
+        try:
+            return memo[key]
+        except KeyError:
+            pass
+
+        rv = memo[key] = self.count_pages(
+            apply_fit(tokens, columns, self.scales[i]))
+        return rv
+
+    def count_pages(self, tokens):
+        """Return the number of pages of the tokens of a song.
+
+        A layout where the chord diagrams overlap the text counts an extra
+        page.
+        """
+        layout = PageCounter(self.stylesheet, self.pagesize)
+        layout.disable_compact = self.disable_compact
+        if self.knownchords is not None:
+            layout.knownchords = self.knownchords
+        layout.new_song(None)
+        for token in tokens:
+            layout.handle_token(token)
+        layout.end_song()
+        return layout.pageno + layout.overlaps
+
+
+def apply_fit(tokens, columns, scale):
+    """Return the tokens of a song laid out in columns with a font scale.
+
+    The titles are scaled too, the columns start below them.
+    """
+    rv = []
+    if scale != 1.0:
+        rv.append(chopro.FontScale(scale))
+    i = 0
+    while i < len(tokens) and isinstance(tokens[i],
+            (chopro.Title, chopro.SubTitle)):
+        i += 1
+    rv.extend(tokens[:i])
+    if columns > 1:
+        rv.append(chopro.Columns(columns))
+    rv.extend(tokens[i:])
+    return rv
@@ -49,10 +49,6 @@ knownchords = {
     'Bmaj7': [2,  None, 1, 3, 2, 3, 1],
     'Bsus4': [2,  None, 1, 1, 3, 4, 1],
     'Bdim':  [1,  None, 2, 3, 4, 3, None],
-    'H':     [2,  None, 1, 3, 3, 3, 1],
-    'Hm':    [2,  None, 1, 3, 3, 2, 1],
-    'H7':    [2,  None, 1, 3, 1, 3, 1],
-    'Hm7':   [2,  None, 1, 3, 1, 2, 1],
     'C':     [1,  None, 3, 2, 0, 1, 0],
     'C/B':   [1,  None, 2, 2, 0, 1, 0],
     'C/D':   [1,  None, None, 0, 0, 1, 0],
@@ -120,10 +116,6 @@ knownchords = {
     'G/B':   [1,  None, 2, 0, 0, 3, 3],
     'G/C':   [1,  None, 3, 0, 0, 0, 3],
     'G/F':   [1,  1, 2, 0, 0, 3, 3],
-    'G#':    [4,  1, 3, 3, 2, 1, 1],
-    'G#7':   [4,  1, 3, 1, 2, 1, 1],
-    'G#m':   [4,  1, 3, 3, 1, 1, 1],
-    'G#m7':  [4,  1, 3, 1, 1, 1, 1],
     'G#dim': [4,  1, 2, 3, 1, None, None],
 }
 
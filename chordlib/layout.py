@@ -0,0 +1,577 @@
+"""
+Layout of the songs on the pages.
+
+`SongsLayout` places the tokens of the songs on pages as positioned boxes,
+measuring the text with the font metrics, but drawing nothing: the boxes
+are painted by a subclass such as `PdfSongsRenderer`, or can be inspected
+to evaluate a layout.
+
+This file is part of chordlab.
+"""
+
+import math
+
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfbase._fontdata import standardFonts
+
+from .render import SongsRenderer
+from . import style
+
+
+class GlyphWidths(dict):
+    """The widths of the characters in a font, in thousandths of the size.
+
+    The widths are read from the font metrics the first time a character
+    is measured.
+    """
+    def __init__(self, fontname):
+        self.font = pdfmetrics.getFont(fontname)
+
+    def __missing__(self, char):
+        font = self.font
+        if isinstance(font, TTFont):
+            rv = font.face.charWidths.get(ord(char), font.face.defaultWidth)
+        else:
+            if not isinstance(char, unicode):
+                char = char.decode('utf8')
+            rv = 0
+            for f, t in pdfmetrics.unicode2T1(char,
+                    [font] + font.substitutionFonts):
+                rv += sum(f.widths[ord(c)] for c in t)
+
+        self[char] = rv
+        return rv
+
+
+class FontRegistry(object):
+    """Keep track of the fonts used by the styles.
+
+    TrueType fonts are registered with reportlab the first time they are
+    used; the (fontname, size) pairs are cached so that the styles using
+    the same font, e.g. the ones compiled or scaled again, share them.
+    Strings are measured with a `GlyphWidths` table per font.
+    """
+    def __init__(self):
+        self._registered = set(f.lower() for f in standardFonts)
+        self._fonts = {}
+        self._tables = {}
+
+    def get_font(self, style):
+        """Return the (fontname, size) pair to render a style."""
+        if style.font_path:
+            key = (style.ttfont, style.font_size)
+        else:
+            key = (style.font, style.font_size)
+
+        try:
+            return self._fonts[key]
+        except KeyError:
+            pass
+
+        if style.font_path:
+            self.register_ttf(style.ttfont, style.font_path)
+        self._fonts[key] = key
+        return key
+
+    def register_ttf(self, name, path):
+        """Register a TrueType font unless already known."""
+        if name.lower() in self._registered:
+            return
+        if name.lower() not in [f.lower() for f in
+                pdfmetrics.getRegisteredFontNames()]:
+            pdfmetrics.registerFont(TTFont(name, path))
+        self._registered.add(name.lower())
+
+    def get_widths(self, fontname):
+        """Return the `GlyphWidths` of a font."""
+        try:
+            return self._tables[fontname]
+        except KeyError:
+            rv = self._tables[fontname] = GlyphWidths(fontname)
+            return rv
+
+    def get_width(self, text, font):
+        """Return the width of a string in a (fontname, size)."""
+        fontname, size = font
+        return sum(map(self.get_widths(fontname).__getitem__, text)) \
+            * 0.001 * size
+
+font_registry = FontRegistry()
+
+
+def fill_count(x, end, width):
+    """Return how many glyphs of a width are needed to go from `x` to `end`.
+
+    The result is the same as drawing one glyph at a time until the cursor
+    reaches `end`, adding up the widths with their rounding errors.
+    """
+    if x >= end or not width:
+        return 0
+
+    n = (end - x) / width
+    rv = int(math.ceil(n))
+    if rv - n > 1e-6 and n - (rv - 1) > 1e-6:
+        return rv
+
+    # too close to a whole number of glyphs for the rounding errors
+    rv = 0
+    while x < end:
+        x += width
+        rv += 1
+    return rv
+
+
+class Box(object):
+    """An element placed on a page.
+
+    Boxes only contain marshallable values, so they can be compared,
+    stored or sent to other processes. Styles are referred by name.
+    """
+    __slots__ = ()
+
+    # small integer identifying the box class, set below
+    kind = None
+
+    def __init__(self, *args):
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__,
+            ', '.join(map(repr, self.get_state())))
+
+    def __eq__(self, other):
+        return self.__class__ is other.__class__ \
+            and self.get_state() == other.get_state()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def get_state(self):
+        """Return the box content as a marshallable object."""
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    @classmethod
+    def from_state(cls, state):
+        """Create a box from the result of `get_state()`."""
+        return cls(*state)
+
+    def __reduce__(self):
+        return (_restore_box, (self.kind, self.get_state()))
+
+class TextLine(Box):
+    """A line of text starting at (x, y).
+
+    `runs` is a tuple of (x, style name, rise, text): each run starts where
+    the previous one ends unless its x says otherwise.
+    """
+    __slots__ = ('x', 'y', 'runs')
+
+class Text(Box):
+    """A string aligned 'left', 'right' or 'center' to a position."""
+    __slots__ = ('style', 'x', 'y', 'align', 'text')
+
+class Rule(Box):
+    """A line from (x1, y1) to (x2, y2)."""
+    __slots__ = ('x1', 'y1', 'x2', 'y2')
+
+class ChordGrid(Box):
+    """The diagrams of the chords of a song.
+
+    `diagrams` is a tuple of (x, y, chord name, voicing), in the units of
+    the chordbox style, scaled by `scale`.
+    """
+    __slots__ = ('scale', 'diagrams')
+
+
+box_classes = [TextLine, Text, Rule, ChordGrid]
+for i, cls in enumerate(box_classes):
+    cls.kind = i
+
+def _restore_box(kind, state):
+    return box_classes[kind].from_state(state)
+
+
+class Page(object):
+    """A page: its number, the area to place the boxes in and the boxes."""
+    def __init__(self, number, left, right, top, bottom, filename):
+        self.number = number
+        self.left = left
+        self.right = right
+        self.top = top
+        self.bottom = bottom
+        self.filename = filename
+        self.boxes = []
+
+    def __repr__(self):
+        return "<Page %s: %d boxes>" % (self.number, len(self.boxes))
+
+
+class SongsLayout(SongsRenderer):
+    """Place the songs on pages as boxes.
+
+    The pages and the boxes are passed to `add_page()` and `add_box()` as
+    soon as they are placed: by default they are stored in `pages`.
+    """
+    def __init__(self, stylesheet=None, pagesize=A4):
+        super(SongsLayout, self).__init__()
+
+        # config
+        self.disable_compact = False
+        if stylesheet is None:
+            stylesheet = style.get_base_stylesheet()
+        self.stylesheet = stylesheet
+        self.pagesize = pagesize
+
+        # the styles of the current song
+        self.style = stylesheet
+
+        self.pages = []
+        self.page = None
+        self.xpos = self.ypos = self.colw = self.colleft = None
+        self.tabmode = False
+        self.skip_grid = False
+        self.in_chorus = False
+        self.socpos = [0,0]
+        self.colstart = 0
+        self.pageno = 0
+
+    def get_flow_state(self):
+        """Return what the layout of the next song depends on but its tokens.
+
+        The page parity is included for duplex documents, because the
+        margins of the pages depend on it.
+        """
+        if self.style['songsheet'].duplex:
+            parity = self.pageno % 2
+        else:
+            parity = 0
+        return (parity, self.in_chorus, self.tabmode, self.skip_grid,
+            tuple(self.usedchords))
+
+    def add_page(self, page):
+        """Receive a new page, before the boxes placed on it."""
+        self.pages.append(page)
+
+    def add_box(self, box):
+        """Receive a box placed on the current page."""
+        self.page.boxes.append(box)
+
+    def new_song(self, filename):
+        if self.pageno:
+            self.place_chord_boxes()
+        super(SongsLayout, self).new_song(filename)
+        self.style = self.stylesheet
+        self.new_page()
+        self.colw = self.page.right # Any large number, really
+        self.colstart = 0
+        self.socpos = [0,0]
+
+    def end_song(self):
+        """Place the chord boxes of the song, unless the grid is skipped.
+
+        Otherwise they are placed when the next song starts.
+        """
+        if not self.skip_grid:
+            self.place_chord_boxes()
+
+    def new_page(self):
+        """Start a new page and move to its top left corner."""
+        self.pageno += 1
+
+        ss = self.style['songsheet']
+        top = self.pagesize[1] - ss.margin_top
+        bottom = ss.margin_bottom
+
+        if ss.duplex and (self.pageno % 2 == 1):
+            left = ss.margin_left + ss.margin_gutter
+            right = self.pagesize[0] - (ss.margin_right - ss.margin_gutter)
+        else:
+            left = ss.margin_left - ss.margin_gutter
+            right = self.pagesize[0] - (ss.margin_right + ss.margin_gutter)
+
+        self.page = Page(self.pageno, left, right, top, bottom, self.filename)
+        self.add_page(self.page)
+        self.xpos, self.ypos = left, top
+        self.colleft = left
+
+    def column_break(self):
+        in_chorus = self.in_chorus
+        if in_chorus:
+            self.handle_EndOfChorus(None)
+        self.ypos = self.colstart
+        self.xpos += self.colw
+        if (self.xpos + 1 > self.page.right):
+            self.new_page()
+        self.colleft = self.xpos
+        if in_chorus:
+            self.handle_StartOfChorus(None)
+
+    def place_chord_boxes(self):
+        if self.skip_grid or not self.usedchords:
+            self.skip_grid = False
+            return
+
+        style = self.style['chordbox']
+        page = self.page
+        boxw = 38
+        xpos = page.right / style.scale - boxw + 10
+        ypos = page.bottom / style.scale + 8
+        diagrams = []
+        for cname in reversed(self.usedchords):
+            chord = self.get_chord(cname)
+            if not chord:
+                continue
+            diagrams.append((xpos, ypos, cname, tuple(chord)))
+            xpos -= boxw
+            if xpos < page.left:
+                xpos = page.right - boxw + 10
+                ypos += 55
+        self.usedchords.clear()
+        if diagrams:
+            self.add_box(ChordGrid(style.scale, tuple(diagrams)))
+
+
+    def handle_Title(self, token):
+        self._place_title('title', token.arg)
+
+    def handle_SubTitle(self, token):
+        self._place_title('subtitle', token.arg)
+
+    def _place_title(self, style_name, text):
+        style = self.style[style_name]
+        self.ypos -= style.line_height
+        if style.align == 'left':
+            xpos = self.page.left
+        elif style.align == 'right':
+            xpos = self.page.right
+        elif style.align == 'center':
+            xpos = (self.page.left + self.page.right) / 2
+        else:
+            raise ValueError('bad align: %s' % style.align)
+        self.add_box(Text(style_name, xpos, self.ypos, style.align, text))
+
+    def handle_Comment(self, token):
+        style = self.style['comment']
+        self.ypos -= style.line_height
+        self.add_box(Text('comment', self.xpos, self.ypos, 'left', token.arg))
+
+    def handle_StartOfChorus(self, token):
+        self.in_chorus = True
+        self.socpos = [self.xpos-5, self.ypos]
+        self.xpos += self.style['chorus'].indent
+
+    def handle_EndOfChorus(self, token):
+        self.xpos -= self.style['chorus'].indent
+        # TODO: box etc.
+        self.add_box(Rule(self.socpos[0], self.socpos[1],
+                          self.xpos-5, self.ypos-5))
+        self.in_chorus = False
+
+    def handle_StartOfTab(self, token):
+        self.tabmode = True
+
+    def handle_EndOfTab(self, token):
+        self.tabmode = False
+
+    def handle_Columns(self, token):
+        self.colw = (self.page.right - self.page.left) / token.arg
+        self.colstart = self.ypos
+
+    def handle_ColumnBreak(self, token):
+        self.column_break()
+
+    def handle_NewPage(self, token):
+        self.new_page()
+
+    def handle_NewSong(self, token):
+        self.new_song(self.filename)
+
+    def handle_Define(self, token):
+        self.define_chord(token.arg[0], token.arg[1:])
+
+    def handle_FontScale(self, token):
+        self.style = self.stylesheet.scaled(token.arg)
+
+    def handle_NoGrid(self, token):
+        self.skip_grid = True
+
+    def handle_Blank(self, token):
+        style = self.style['blank']
+        self.ypos -= style.line_height
+
+    def handle_TabLine(self, token):
+        style = self.style['tab']
+        h = style.line_height
+        if self.ypos < self.page.bottom + (h * 1.33):
+            self.column_break()
+        self.ypos -= h
+        self.add_box(TextLine(self.xpos, self.ypos,
+            ((self.xpos, 'tab', 0, token.arg),)))
+
+    def handle_Line(self, token):
+        sl = self.style['line']
+        sc = self.style['chord']
+        parts = token.arg
+        chords = token.chords
+        indent = 0
+
+        # place the line in as many rows as needed
+        while parts:
+            if self.ypos < self.page.bottom \
+                    + (sl.line_height + sc.line_height) * 1.1:
+                self.column_break()
+
+            for txt in parts[::2]:
+                if txt and not txt.isspace():
+                    only_chords = False
+                    break
+            else:
+                only_chords = True
+
+            if not only_chords and (self.disable_compact or len(parts) > 1):
+                self.ypos -= sl.line_height + sc.line_height
+            else:
+                self.ypos -= sl.line_height
+
+            parts, chords = self.place_line(self.xpos + indent,
+                parts, chords, only_chords)
+            indent = sl.indent
+
+    # space left between the lines of a column and the next one
+    column_gap = 10
+
+    def get_line_right(self):
+        """Return the position where the lines of the column must end."""
+        right = self.page.right
+        if self.colleft + self.colw < right - 1:
+            right = self.colleft + self.colw - self.column_gap
+        return right
+
+    def place_line(self, x, parts, chords, only_chords):
+        """Place the lyrics and chords parts of a line at `x`.
+
+        The parts not fitting in the column are not placed: return them
+        with their chords, to be placed in a continuation row.
+        """
+        runs, xs, right = self._place_parts(x, parts, chords, only_chords)
+
+        rest = rest_chords = None
+        if right > self.get_line_right():
+            split = self._find_break(parts, xs)
+            if split is not None:
+                i, k = split
+                rest = [parts[i][k+1:].lstrip(' ')] + parts[i+1:]
+                rest_chords = chords[i // 2:]
+                parts = parts[:i] + [parts[i][:k]]
+                chords = chords[:i // 2]
+                runs = self._place_parts(x, parts, chords, only_chords)[0]
+                if len(rest) == 1 and not rest[0]:
+                    rest = None
+
+        self.add_box(TextLine(x, self.ypos, tuple(runs)))
+        return rest, rest_chords
+
+    def _place_parts(self, x, parts, chords, only_chords):
+        """Return the runs drawing parts of a line at `x`.
+
+        Also return the position of every part and the rightmost point
+        reached by the text.
+        """
+        sl = self.style['line']
+        sc = self.style['chord']
+        fl = font_registry.get_font(sl)
+        fc = font_registry.get_font(sc)
+        get_width = font_registry.get_width
+
+        # measure the parts without a call per part
+        wl = font_registry.get_widths(fl[0]).__getitem__
+        wc = font_registry.get_widths(fc[0]).__getitem__
+        sizel = fl[1]
+        sizec = fc[1]
+
+        runs = []
+        xs = []
+        right = x
+        ischord = 0
+        if not only_chords:
+            okpos = 0
+            for i, part in enumerate(parts):
+                xs.append(x)
+                if ischord:
+                    self.use_chord(chords[i // 2])
+
+                    # fill with dots but only in the middle of a word
+                    if i + 1 < len(parts) \
+                            and (not parts[i+1] or parts[i+1].isspace()):
+                        cfill = ' '
+                    else:
+                        cfill = u'\u00B7'
+
+                    if x < okpos:
+                        n = fill_count(x, okpos, get_width(cfill, fl))
+                    else:
+                        n = 0
+                    if n:
+                        fill = cfill * n
+                        runs.append((x, 'line', 0, fill))
+                        x += get_width(fill, fl)
+                        xs[-1] = x
+
+                    # the lyrics continue below the chord
+                    runs.append((x, 'chord', sc.rise, part))
+                    okpos = x + sum(map(wc, part)) * 0.001 * sizec + 3
+                    right = max(right, okpos - 3)
+                else:
+                    runs.append((x, 'line', 0, part))
+                    x += sum(map(wl, part)) * 0.001 * sizel
+                ischord = not ischord
+
+        else:
+            for i, part in enumerate(parts):
+                xs.append(x)
+                if ischord:
+                    self.use_chord(chords[i // 2])
+                    runs.append((x, 'chord', 0, part))
+                    x += sum(map(wc, part)) * 0.001 * sizec
+                else:
+                    runs.append((x, 'line', 0, part))
+                    x += sum(map(wl, part)) * 0.001 * sizel
+                ischord = not ischord
+
+        return runs, xs, max(right, x)
+
+    def _find_break(self, parts, xs):
+        """Return where to break a line too long for the column.
+
+        Lines are broken at a space in the lyrics: return the index of the
+        part and the offset of the space in it, None if there is no space
+        to break at. Break at the last space fitting in the column or, if
+        none fits, at the first one.
+        """
+        fl = font_registry.get_font(self.style['line'])
+        fc = font_registry.get_font(self.style['chord'])
+        get_width = font_registry.get_width
+        limit = self.get_line_right()
+        rv = None
+        right = xs[0]
+        for i, part in enumerate(parts):
+            x = xs[i]
+            if i % 2:
+                right = max(right, x + get_width(part, fc))
+                continue
+
+            k = part.find(' ')
+            while k >= 0:
+                # don't leave an empty row
+                if i > 0 or part[:k].strip():
+                    if max(right, x + get_width(part[:k], fl)) > limit:
+                        return rv or (i, k)
+                    rv = (i, k)
+                k = part.find(' ', k + 1)
+
+            right = max(right, x + get_width(part, fl))
+
+        return rv
@@ -3,75 +3,311 @@ Rendering of songs in pdf
 
 This file is part of chordlab.
 """
+import re
+
+import reportlab
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 
 from collections import OrderedDict
-from .render import SongsRenderer
-from . import style
+from .layout import SongsLayout, box_classes, font_registry
 
-class PdfSongsRenderer(SongsRenderer):
-    def __init__(self, canvas):
-        super(PdfSongsRenderer, self).__init__()
 
-        # config
-        self.disable_compact = False
-        self.style = style.get_base_stylesheet()
+class TextEmitter(object):
+    """Write text on a canvas emitting only the changes in text state.
 
+    Text is accumulated into the same text object until `end()` is called,
+    so that a run of lines can share it. Font, rise and fill color are only
+    set on the text object when they change.
+    """
+    def __init__(self, canvas):
         self.canvas = canvas
-        self.xpos = self.ypos = self.colw = None
-        self.tabmode = False
-        self.skip_grid = False
-        self.in_chorus = False
-        self.socpos = [0,0]
-        self.colstart = 0
-        self.pageno = 0
-
-    def new_song(self, filename):
+        self.textobj = None
+        self._font = self._rise = self._color = None
+
+    def begin(self, x, y):
+        """Move to a position and return the text object to write on."""
+        if self.textobj is None:
+            self.textobj = self.canvas.beginText(x, y)
+            self._font = self._rise = self._color = None
+        else:
+            self.textobj.setTextOrigin(x, y)
+        return self.textobj
+
+    def end(self):
+        """Draw the pending text, if any, on the canvas."""
+        if self.textobj is not None:
+            self.canvas.drawText(self.textobj)
+            self.textobj = None
+
+    def set_style(self, style, rise=0):
+        font = font_registry.get_font(style)
+        if font != self._font:
+            self.textobj.setFont(*font)
+            self._font = font
+
+        if rise != self._rise:
+            self.textobj.setRise(rise)
+            self._rise = rise
+
+        if style.color is not self._color:
+            self.textobj.setFillColor(style.color)
+            self._color = style.color
+
+# Names in the page operations depending on the document: fonts, forms and
+# graphic states. Strings are matched too, to skip their content.
+_names_re = re.compile(r"""
+    \((?:[^\\()]|\\.)*\)
+    | /(?P<font> F\S*)(?=\s+[\d.]+\s+Tf)
+    | /FormXob\.(?P<form> \S+)(?=\s+Do)
+    | /(?P<gs> \S+)(?=\s+gs)
+    """, re.VERBOSE | re.DOTALL)
+
+
+class PdfSongsRenderer(SongsLayout):
+    """Draw the boxes of the songs layout on a canvas, as they are placed."""
+    def __init__(self, canvas, stylesheet=None):
+        super(PdfSongsRenderer, self).__init__(stylesheet, canvas.pagesize)
+        self.canvas = canvas
+        self._recorded = None
+        self._page_start = None
+        self.text = TextEmitter(canvas)
+        self._painters = dict((cls, getattr(self, 'draw_' + cls.__name__))
+            for cls in box_classes)
+
+    def get_song_state(self):
+        """Return what the pages of the next song depend on but its tokens.
+
+        This is the `get_flow_state()` of the layout and the configuration
+        of the document.
+        """
+        return (reportlab.Version, self.stylesheet.get_digest(),
+            tuple(self.canvas.pagesize), self.canvas.showfilenames,
+            self.knownchords.get_digest(), self.disable_compact) \
+            + self.get_flow_state()
+
+    def start_recording(self):
+        """Record the pages of the song started by the next `new_song()`."""
+        self._recorded = []
+        self._page_start = None
+
+    def stop_recording(self):
+        """Stop recording and return the pages of the song.
+
+        The song is ended by `end_song()`. The page numbers and the other
+        decorations drawn by `add_page()` are not recorded. Return None if the
+        pages can't be replayed in another document, e.g. if they use
+        TrueType fonts, whose subsets depend on the whole document.
+        """
+        self.end_song()
+        self._record_page()
+        pages, self._recorded = self._recorded, None
+
+        fontnames = self.canvas.get_font_names()
+        formnames = dict((v, k) for k, v in self.canvas.forms.iteritems())
+        fonts = []
+        forms = []
+        seen = set()
+        for i, (code, used) in enumerate(pages):
+            for op in code:
+                if 'Tf' not in op and 'Do' not in op and 'gs' not in op:
+                    continue
+                for m in _names_re.finditer(op):
+                    if m.group('gs') is not None:
+                        return None
+                    name = m.group('font')
+                    if name is None or name in seen:
+                        continue
+                    fontname = fontnames.get(name)
+                    if fontname is None or isinstance(
+                            pdfmetrics.getFont(fontname), TTFont):
+                        return None
+                    fonts.append((i, name, fontname))
+                    seen.add(name)
+
+            for name in used:
+                if name in seen:
+                    continue
+                if name not in formnames:
+                    return None
+                cname, chord, style = formnames[name]
+                forms.append((name, cname, list(chord)))
+                seen.add(name)
+
+        state = (self.xpos, self.ypos, self.colw, self.colstart,
+            self.in_chorus, tuple(self.socpos), self.tabmode, self.skip_grid,
+            tuple(self.usedchords))
+        return {'pages': pages, 'fonts': fonts, 'forms': forms,
+            'state': state}
+
+    def replay_song(self, filename, song):
+        """Draw the pages of a song returned by `stop_recording()`."""
         if self.pageno:
-            self.draw_chord_boxes()
-        super(PdfSongsRenderer, self).new_song(filename)
-        self.xpos, self.ypos = self.newPage(filename)
-        self.colw = self.canvas.get_right() # Any large number, really
-
-    def column_break(self):
-        in_chorus = self.in_chorus
-        if in_chorus:
-            self.handle_EndOfChorus(None)
-        self.ypos = self.colstart
-        self.xpos += self.colw
-        if (self.xpos + 1 > self.canvas.get_right()):
-            self.xpos, self.ypos = self.newPage(self.filename)
-        if in_chorus:
-            self.handle_StartOfChorus(None)
-
-    def draw_chord_boxes(self):
-        if self.skip_grid:
-            self.skip_grid = False
-            return
+            self.place_chord_boxes()
+        super(SongsLayout, self).new_song(filename)
+        self.style = self.stylesheet
+
+        def rename(m):
+            if m.group('font') is not None:
+                return '/' + names[m.group('font')]
+            elif m.group('form') is not None:
+                return '/FormXob.' + names[m.group('form')]
+            else:
+                return m.group()
+
+        # resolve the names when the objects would be created in a new
+        # rendering, so that the document is the same
+        names = {}
+        formdefs = dict((name, (cname, chord))
+            for name, cname, chord in song['forms'])
+        renamed = False
+        for i, (code, forms) in enumerate(song['pages']):
+            self.new_page()
+            for page, name, fontname in song['fonts']:
+                if page == i:
+                    names[name] = self.canvas.get_internal_font_name(fontname)
+                    renamed = renamed or names[name] != name
+            for name in forms:
+                if name not in names:
+                    names[name] = self._chord_form(*formdefs[name])
+                    renamed = renamed or names[name] != name
+
+            if renamed:
+                code = [_names_re.sub(rename, op)
+                    if 'Tf' in op or 'Do' in op else op for op in code]
+            self.canvas.add_page_code(code, [names[f] for f in forms])
+
+        (self.xpos, self.ypos, self.colw, self.colstart,
+            self.in_chorus, socpos, self.tabmode, self.skip_grid,
+            usedchords) = song['state']
+        self.socpos = list(socpos)
+        self.usedchords = OrderedDict((c, True) for c in usedchords)
+
+    def _record_page(self):
+        self.text.end()
+        if self._recorded is not None and self._page_start is not None:
+            self._recorded.append(
+                self.canvas.get_page_code(self._page_start))
+
+    def add_page(self, page):
+        canvas = self.canvas
 
-        style = self.style['chordbox']
+        self.text.end()
+        if page.number > 1:
+            self._record_page()
+            canvas.showPage()
+
+        ss = self.style['songsheet']
+        sp = self.style['page-number']
+
+        canvas.top = page.top
+        canvas.bottom = page.bottom
+        canvas.left = page.left
+        canvas.right = page.right
+
+        if sp.display:
+            self._set_font(canvas, sp)
+            if ss.duplex and (page.number % 2 == 1):
+                canvas.drawRightString(canvas.right, canvas.bottom - 9,
+                    str(page.number))
+            else:
+                canvas.drawString(canvas.left, canvas.bottom - 9,
+                    str(page.number))
+
+        canvas.line(canvas.left, canvas.top,
+            canvas.right, canvas.top)
+        canvas.line(canvas.left, canvas.bottom,
+            canvas.right, canvas.bottom)
+
+        if canvas.showfilenames:
+            canvas.setFont('Helvetica', 8)
+            if ss.duplex and (page.number % 2 == 1):
+                canvas.drawString(canvas.left, canvas.bottom - 9,
+                    page.filename)
+            else:
+                canvas.drawRightString(canvas.right, canvas.bottom - 9,
+                    page.filename)
+
+        self._page_start = canvas.get_code_size()
+
+    def add_box(self, box):
+        self._painters[box.__class__](box)
+
+    def draw_TextLine(self, box):
+        to = self.text.begin(box.x, box.y)
+        for x, style_name, rise, text in box.runs:
+            if x != to.getCursor()[0]:
+                to.setTextOrigin(x, box.y)
+            self.text.set_style(self.style[style_name], rise)
+            to.textOut(text)
+
+    def draw_Text(self, box):
+        self.text.end()
+        style = self.style[box.style]
+        self._set_font(self.canvas, style)
+        self.canvas.setFillColor(style.color)
+        if box.align == 'left':
+            self.canvas.drawString(box.x, box.y, box.text)
+        elif box.align == 'right':
+            self.canvas.drawRightString(box.x, box.y, box.text)
+        else:
+            self.canvas.drawCentredString(box.x, box.y, box.text)
+
+    def draw_Rule(self, box):
+        self.text.end()
+        self.canvas.line(box.x1, box.y1, box.x2, box.y2)
+
+    def draw_ChordGrid(self, box):
+        self.text.end()
         self.canvas.saveState()
-        boxw = 38
-        xpos = (self.canvas.get_right()) / style.scale - boxw + 10
-        ypos = (self.canvas.get_bottom()) / style.scale + 8
-        self.canvas.scale(style.scale, style.scale)
-        for cname in reversed(self.usedchords):
-            chord = self.localchords.get(cname) or self.knownchords.get(cname)
-            if not chord:
-                continue
+        self.canvas.scale(box.scale, box.scale)
+        for xpos, ypos, cname, chord in box.diagrams:
             self.draw_chord_box(xpos, ypos, cname, chord)
-            xpos -= boxw
-            if xpos < self.canvas.get_left():
-                xpos = self.canvas.get_right() - boxw + 10
-                ypos += 55
-        self.usedchords = OrderedDict()
         self.canvas.restoreState()
 
     def draw_chord_box(self, xpos, ypos, cname, chord):
+        form = self._chord_form(cname, chord)
+        self.canvas.saveState()
+        self.canvas.translate(xpos, ypos)
+        self.canvas.doForm(form)
+        self.canvas.restoreState()
+
+    def _chord_form(self, cname, chord):
+        """Return the name of a form drawing a chord diagram.
+
+        Every diagram is drawn only once in the document and referenced
+        by all the songs using it.
+        """
+        style = self.style['chordbox']
+        key = (cname, tuple(chord), style)
+        try:
+            return self.canvas.forms[key]
+        except KeyError:
+            pass
+
+        name = 'chordbox%d' % len(self.canvas.forms)
+        nstrings = len(chord) - 1
+        dx = 5 * 6 / nstrings
+        dy = 7
+
+        # bounding box of the form, including the labels
+        font_registry.get_font(style)       # registers a ttf if needed
+        labelw = pdfmetrics.stringWidth(cname, style.ttfont, 10)
+        center = dx * 0.5 * (nstrings - 1)
+        self.canvas.beginForm(name,
+            min(-2 * dx, center - labelw / 2) - 2, -dy,
+            max(nstrings * dx, center + labelw / 2) + 2, 5.1 * dy + 12)
+        self._draw_chord_diagram(cname, chord, style)
+        self.canvas.endForm()
+
+        self.canvas.forms[key] = name
+        return name
+
+    def _draw_chord_diagram(self, cname, chord, style):
         nstrings = len(chord) - 1
         dx = 5 * 6 / nstrings
         dy = 7
+        xpos = ypos = 0
 
         self.canvas.saveState()
         clip = self.canvas.beginPath()
@@ -88,7 +324,6 @@ class PdfSongsRenderer(SongsRenderer):
             [ypos + dy*y for y in range(-1, 6)])
         self.canvas.restoreState()
 
-        style = self.style['chordbox']
         self.canvas.setFillColor(style.color)
         self._set_font(self.canvas, style)
         self.canvas.setFont(style.ttfont, 10)
@@ -128,206 +363,9 @@ class PdfSongsRenderer(SongsRenderer):
 
     def end_of_input(self):
         super(PdfSongsRenderer, self).end_of_input()
+        self.text.end()
         self.canvas.showPage()
         self.canvas.save()
 
-
-    def handle_Title(self, token):
-        self._draw_title('title', token.arg)
-
-    def handle_SubTitle(self, token):
-        self._draw_title('subtitle', token.arg)
-
-    def _draw_title(self, style_name, text):
-        style = self.style[style_name]
-        self._set_font(self.canvas, style)
-        self.canvas.setFillColor(style.color)
-        self.ypos -= style.line_height
-        self.canvas.draw_aligned_string(style.align, self.ypos, text)
-
-    def handle_Comment(self, token):
-        style = self.style['comment']
-        self._set_font(self.canvas, style)
-        self.canvas.setFillColor(style.color)
-        self.ypos -= style.line_height
-        self.canvas.drawString(self.xpos, self.ypos, token.arg)
-
-    def handle_StartOfChorus(self, token):
-        self.in_chorus = True
-        self.socpos = [self.xpos-5, self.ypos]
-        self.xpos += self.style['chorus'].indent
-
-    def handle_EndOfChorus(self, token):
-        self.xpos -= self.style['chorus'].indent
-        # TODO: box etc.
-        self.canvas.line(self.socpos[0], self.socpos[1],
-                         self.xpos-5, self.ypos-5)
-        self.in_chorus = False
-
-    def handle_StartOfTab(self, token):
-        style = self.style['tab']
-        self._set_font(self.canvas, style)
-        self.tabmode = True
-
-    def handle_EndOfTab(self, token):
-        self.tabmode = False
-
-    def handle_Columns(self, token):
-        self.colw = (self.canvas.get_right() - self.canvas.get_left()) \
-                / token.arg
-        self.colstart = self.ypos
-        # print "Pagew:", A4[0] - 2*margin, "cols:", coln, "colw:", colw
-
-    def handle_ColumnBreak(self, token):
-        self.column_break()
-
-    def handle_NewPage(self, token):
-        self.xpos,self.ypos = self.newPage(self.filename)
-
-    def handle_NewSong(self, token):
-        self.new_song(self.filename)
-
-    def handle_Define(self, token):
-        self.define_chord(token.arg[0], token.arg[1:])
-
-    def handle_NoGrid(self, token):
-        self.skip_grid = True
-
-    def handle_Blank(self, token):
-        style = self.style['blank']
-        self.ypos -= style.line_height
-
-    def handle_TabLine(self, token):
-        style = self.style['tab']
-        self._set_font(self.canvas, style)
-        self.canvas.setFillColor(style.color)
-        h = style.line_height
-        if self.ypos < self.canvas.get_bottom() + (h * 1.33):
-            self.column_break()
-        self.ypos -= h
-        self.canvas.drawString(self.xpos, self.ypos, token.arg)
-
-    def handle_Line(self, token):
-        sl = self.style['line']
-        sc = self.style['chord']
-
-        if self.ypos < self.canvas.get_bottom() \
-                + (sl.line_height + sc.line_height) * 1.1:
-            self.column_break()
-
-        parts = token.arg
-
-        for txt in parts[::2]:
-            if txt and not txt.isspace():
-                only_chords = False
-                break
-        else:
-            only_chords = True
-
-        if not only_chords and (self.disable_compact or len(parts) > 1):
-            self.ypos -= sl.line_height + sc.line_height
-        else:
-            self.ypos -= sl.line_height
-
-        to = self.canvas.beginText(self.xpos, self.ypos)
-        ischord = 0
-        if not only_chords:
-            okpos = 0
-            for i, x in enumerate(parts):
-                if ischord:
-                    self.use_chord(x)
-
-                    # fill with dots but only in the middle of a word
-                    csp = to.getCursor()
-                    if i + 1 < len(parts) \
-                            and (not parts[i+1] or parts[i+1].isspace()):
-                        cfill = ' '
-                    else:
-                        cfill = u'\u00B7'
-
-                    while csp[0] < okpos:
-                        to.textOut(cfill)
-                        csp = to.getCursor()
-                    self._set_font(to, sc)
-                    to.setRise(sc.rise)
-                    to.setFillColor(sc.color)
-                else:
-                    self._set_font(to, sl)
-                    to.setRise(0)
-                    to.setFillColor(sl.color)
-                to.textOut(x)
-                if ischord:
-                    okpos = to.getCursor()[0] + 3
-                    to.setTextOrigin(csp[0], csp[1])
-                ischord = not ischord
-
-        else:
-            for x in parts:
-                if ischord:
-                    self.use_chord(x)
-                    self._set_font(to, sc)
-                    to.setFillColor(sc.color)
-                else:
-                    self._set_font(to, sl)
-                    to.setFillColor(sl.color)
-                to.textOut(x)
-                ischord = not ischord
-
-        self.canvas.drawText(to)
-
     def _set_font(self, obj, style):
-        if style.font_path:
-            fontnames = [x.lower() for x in
-                    self.canvas.getAvailableFonts()]
-            if style.ttfont.lower() not in fontnames:
-                pdfmetrics.registerFont(TTFont(style.ttfont,
-                    style.font_path))
-            obj.setFont(style.ttfont, style.font_size)
-        else:
-            obj.setFont(style.font, style.font_size)
-
-    def newPage(self, filename):
-        canvas = self.canvas
-
-        if self.pageno > 0: canvas.showPage()
-        self.pageno += 1
-
-        ss = self.style['songsheet']
-        sp = self.style['page-number']
-
-        canvas.top = canvas.pagesize[1] - ss.margin_top
-        canvas.bottom = ss.margin_bottom
-
-        if ss.duplex and (self.pageno % 2 == 1):
-            canvas.left = ss.margin_left + ss.margin_gutter
-            canvas.right = canvas.pagesize[0] \
-                    - (ss.margin_right - ss.margin_gutter)
-
-            if sp.display:
-                self._set_font(self.canvas, sp)
-                canvas.drawRightString(canvas.right, canvas.bottom - 9,
-                    str(self.pageno))
-        else:
-            canvas.left = ss.margin_left - ss.margin_gutter
-            canvas.right = canvas.pagesize[0] \
-                - (ss.margin_right + ss.margin_gutter)
-
-            if sp.display:
-                self._set_font(self.canvas, sp)
-                canvas.drawString(canvas.left, canvas.bottom - 9,
-                    str(self.pageno))
-
-        canvas.line(canvas.left, canvas.top,
-            canvas.right, canvas.top)
-        canvas.line(canvas.left, canvas.bottom,
-            canvas.right, canvas.bottom)
-
-        if canvas.showfilenames:
-            canvas.setFont('Helvetica', 8)
-            if ss.duplex and (self.pageno % 2 == 1):
-                canvas.drawString(canvas.left, canvas.bottom - 9, filename)
-            else:
-                canvas.drawRightString(canvas.right, canvas.bottom - 9, filename)
-
-        return (canvas.left, canvas.top)
-
+        obj.setFont(*font_registry.get_font(style))
@@ -4,23 +4,91 @@ Base songsheet renderer class.
 This file is part of chordlab.
 """
 
-import re
 from collections import OrderedDict
 
+from . import chopro
+from .chords import ChordIndex, ChordSymbol, chord_symbol, no_chords
+from .voicing import ChordLibrary
+
 import logging
 logger = logging.getLogger("chordlib.render")
 
+class HandlersTable(dict):
+    """Map token classes to the function handling them in a renderer class.
+
+    A token is handled by the handler registered for its class or, failing
+    that, by the method called 'handle_' + the class name. Base token
+    classes are tried if no handler is found, then `handle_unknown()`.
+    """
+    def __init__(self, renderer_cls):
+        super(HandlersTable, self).__init__()
+        self.renderer_cls = renderer_cls
+        for token_cls in chopro.token_classes:
+            self[token_cls]
+
+    def __missing__(self, token_cls):
+        rv = self._find_handler(token_cls)
+        self[token_cls] = rv
+        return rv
+
+    def _find_handler(self, token_cls):
+        for tcls in token_cls.__mro__:
+            for rcls in self.renderer_cls.__mro__:
+                rv = rcls.__dict__.get('_registered', {}).get(tcls)
+                if rv is not None:
+                    return rv
+                rv = rcls.__dict__.get('handle_' + tcls.__name__)
+                if rv is not None:
+                    return rv
+
+        return self.renderer_cls.handle_unknown.__func__
+
+
 class SongsRenderer(object):
     """Handle rendering tokens received by a parser"""
     def __init__(self):
         self.filename = None
-        self.knownchords = {}
+        self.knownchords = ChordLibrary({})
         self.localchords = {}
         self.usedchords = OrderedDict()
+        self._local_index = ChordIndex()
+        self._song_chords = {}
+        self._handlers = self.get_handlers()
+
+    @classmethod
+    def get_handlers(cls):
+        """Return the `HandlersTable` of the renderer class."""
+        try:
+            return cls.__dict__['_handlers_table']
+        except KeyError:
+            cls._handlers_table = HandlersTable(cls)
+            return cls._handlers_table
+
+    @classmethod
+    def register_handler(cls, token_cls, func):
+        """Use a function to handle a token class in this renderer class.
+
+        The function is called with the renderer and the token as
+        arguments. It is also used by subclasses not handling the token.
+        """
+        if '_registered' not in cls.__dict__:
+            cls._registered = {}
+        cls._registered[token_cls] = func
+
+        # Reset the tables of this class and its subclasses. Clear them in
+        # place, as they are referenced by the renderers instances.
+        stack = [cls]
+        while stack:
+            rcls = stack.pop()
+            if '_handlers_table' in rcls.__dict__:
+                rcls._handlers_table.clear()
+            stack.extend(rcls.__subclasses__())
 
     def new_song(self, filename):
         self.filename = filename
         self.localchords = {}
+        self._local_index = ChordIndex()
+        self._song_chords = {}
 
     def define_chord(self, name, args):
         def string_value(v):
@@ -32,26 +100,47 @@ class SongsRenderer(object):
         if args[0] == 'base-fret' and args[2] == 'frets':
             base_fret = int(args[1])
             self.localchords[name] = [base_fret] + map(string_value, args[3:])
+            self._local_index.add(name)
+            self._song_chords = {}
         else:
             logger.warn("Bad chorddef " + name + ": " + str(args))
 
     def use_chord(self, chord):
-        chord = re.sub('\s*\(.*\)', '', chord)      # strip (parens)
-        chord = re.sub('(\s*/\s*)*$', '', chord)    # strip trailing / / /
-        if not (chord in ['N.C.', '%', '-', ''] or chord in self.usedchords):
-            self.usedchords[chord] = True
-            if not (chord in self.knownchords or chord in self.localchords):
-                logger.warn("Unknown chord: %s", chord)
+        """Record the use of a chord in the song; return its normalized name.
+
+        `chord` can be a `ChordSymbol` or a chord name. Each distinct
+        spelling is only checked once per song.
+        """
+        try:
+            return self._song_chords[chord]
+        except KeyError:
+            pass
+
+        if not isinstance(chord, ChordSymbol):
+            chord = chord_symbol(chord)
+        name = self._song_chords[chord] = chord.key
+        if not (name in no_chords or name in self.usedchords):
+            self.usedchords[name] = True
+            if self.get_chord(name) is None:
+                logger.warn("Unknown chord: %s", name)
+
+        return name
+
+    def get_chord(self, name):
+        """Return the voicing of a chord, by any spelling, or None.
+
+        The chords defined in the song are looked up before the known ones.
+        """
+        rv = self._local_index.lookup(self.localchords, name)
+        if rv is None:
+            rv = self.knownchords.get(name)
+        return rv
 
     def end_of_input(self):
         pass
 
     def handle_token(self, token):
-        meth = 'handle_' + token.__class__.__name__
-        meth = getattr(self, meth, None)
-        if meth is None:
-            meth = self.handle_unknown
-        meth(token)
+        self._handlers[token.__class__](self, token)
 
     def handle_unknown(self, token):
         logger.warn("%s can't handle %r", self.__class__.__name__, token)
@@ -4,16 +4,23 @@ Main script and command line parsing.
 This file is part of chordlab.
 """
 
+import os
 import sys
 from copy import copy
+from collections import deque
 from optparse import Option, OptionValueError, OptionParser
 
+from . import chopro
 from . import consts
+from . import style
 from .canvas import CanvasAdapter
 from .chopro import ChoProParser
+from .chorddb import ChordDatabase
 from .error import ChordLibError
+from .fit import PageCounter, SongFitter
 from .pdf import PdfSongsRenderer
-from .xpose import xpose
+from .voicing import ChordLibrary, VoicingGenerator, tunings
+from .xpose import xpose, Transposer, KeyChooser
 
 import logging
 logger = logging.getLogger('chordlib.script')
@@ -42,37 +49,420 @@ def script():
 def main():
     opt = make_option_parser()
     (options, sourcefiles) = opt.parse_args()
+    if options.xpose and (options.auto_key or options.best_capo):
+        opt.error("--xpose can't be used with --auto-key/--best-capo")
+    if not 1 <= options.fit_min_scale <= 100:
+        opt.error("--fit-min-scale must be between 1 and 100")
 
-    # TODO: per-renderer config
-    c = CanvasAdapter(options.output, showfilenames=options.showfiles,
-                      pagesize=options.pagesize,
-                      title=options.doctitle, author=options.docauthor)
-    r = PdfSongsRenderer(c)
-    if options.styles:
-        r.style.read(*options.styles)
-    r.disable_compact = options.disable_compact
+    stylesheet = get_stylesheet(options)
+    knownchords = get_knownchords(options)
+    page_cache = get_page_cache(options)
+    shifts = options.xpose or [0]
+
+    if options.auto_key or options.best_capo:
+        # choose the transposition of each file after parsing it all
+        fp = FileParser(options, 0)
+        chooser = KeyChooser(knownchords)
+        rv = render(options, stylesheet, knownchords, page_cache,
+            options.output, (
+                (fn, auto_transpose(fn, tokens, chooser, options.best_capo))
+                for fn, tokens in iter_songs(fp, sourcefiles, options.jobs)))
+
+    elif len(shifts) == 1:
+        # transpose while parsing and render the songs as they come
+        fp = FileParser(options, shifts[0])
+        rv = render(options, stylesheet, knownchords, page_cache,
+            options.output, iter_songs(fp, sourcefiles, options.jobs))
 
-    if options.ukulele:
-        from .ukulele import knownchords
     else:
-        from .guitar import knownchords
+        # parse once, then render a document for each key
+        fp = FileParser(options, 0)
+        songs = []
+        for fn, tokens in iter_songs(fp, sourcefiles, options.jobs):
+            try:
+                tokens = list(tokens)
+            except ChoProParser.ParseError, e:
+                logger.error("error parsing file '%s': %s", fn, e)
+                return 1
+            xp = Transposer()
+            xp.guess_key(tokens)
+            songs.append((fn, tokens, xp))
 
-    r.knownchords = knownchords
+        for shift in shifts:
+            rv = render(options, stylesheet, knownchords, page_cache,
+                get_output_name(options.output, shift), (
+                    (fn, (xpose(t, shift, xp) for t in tokens))
+                    for fn, tokens, xp in songs))
+            if rv:
+                break
+
+    # saved first, so that the voicings file is counted as recently used
+    knownchords.generator.save()
+    if page_cache is not None:
+        # the entries of the parse cache and the voicings are evicted too
+        page_cache.evict()
+
+    return rv
+
+
+def render(options, stylesheet, knownchords, page_cache, output, songs):
+    """Render a sequence of (filename, tokens) in an output file.
+
+    If `page_cache` is not None, the songs already rendered in the same
+    conditions are drawn from the cache.
+    """
+    if options.fit:
+        fitter = SongFitter(stylesheet, options.pagesize,
+            min_scale=options.fit_min_scale * 0.01)
+        fitter.disable_compact = options.disable_compact
+        fitter.knownchords = knownchords
+        songs = ((fn, fitter.fit(fn, tokens)) for fn, tokens in songs)
+
+    if options.jobs > 1:
+        return render_parallel(options, stylesheet, knownchords, page_cache,
+            output, songs)
 
-    p = ChoProParser(default_encoding='utf8')
-    for fn in sourcefiles:
-        r.new_song(fn)
+    r = make_renderer(options, stylesheet, knownchords,
+        make_canvas(options, output, options.stream))
+    for fn, tokens in songs:
         try:
-            for token in p.parse_file(fn):
-                r.handle_token(xpose(token, options.xpose))
-        except p.ParseError, e:
+            if page_cache is not None:
+                render_cached(r, page_cache, fn, tokens)
+            else:
+                r.new_song(fn)
+                for token in tokens:
+                    r.handle_token(token)
+        except ChoProParser.ParseError, e:
             logger.error("error parsing file '%s': %s", fn, e)
             return 1
 
-    r.draw_chord_boxes()
+    r.place_chord_boxes()
+    r.end_of_input()
+
+
+def make_canvas(options, output, streaming=False):
+    """Return the `CanvasAdapter` to write a file."""
+    return CanvasAdapter(output, showfilenames=options.showfiles,
+                         pagesize=options.pagesize,
+                         title=options.doctitle, author=options.docauthor,
+                         streaming=streaming)
+
+
+def make_renderer(options, stylesheet, knownchords, canvas):
+    """Return a `PdfSongsRenderer` drawing on a canvas."""
+    # TODO: per-renderer config
+    r = PdfSongsRenderer(canvas, stylesheet)
+    r.disable_compact = options.disable_compact
+    r.knownchords = knownchords
+    return r
+
+
+def render_cached(renderer, page_cache, fn, tokens):
+    """Render a song, reusing its pages if found in the cache."""
+    tokens = list(tokens)
+    key = page_cache.get_key(tokens, renderer.get_song_state())
+    song = page_cache.load(key)
+    if song is not None:
+        renderer.replay_song(fn, song)
+        return
+
+    renderer.start_recording()
+    renderer.new_song(fn)
+    for token in tokens:
+        renderer.handle_token(token)
+    song = renderer.stop_recording()
+    if song is not None:
+        page_cache.save(key, song)
+
+
+def render_parallel(options, stylesheet, knownchords, page_cache, output,
+        songs):
+    """Render the songs in a pool of processes, then assemble them in order.
+
+    A `PageCounter` follows the flow of the document, giving the state each
+    song starts in, e.g. the parity of its first page. The songs starting
+    as in a new document, on a page of that parity, are drawn in the pool;
+    the others are drawn in the output document. The pages drawn in the
+    pool are replayed in the output document, with their page numbers, as
+    soon as the songs before them are done.
+
+    A song found in a different state than the one it was drawn in (e.g.
+    if its pages were not counted right) is drawn again.
+    """
+    # the state of the renderer at the start of an independent song, by
+    # the flow state of the layout
+    states = {}
+    for parity in (0, 1):
+        r = make_renderer(options, stylesheet, knownchords,
+            make_canvas(options, os.devnull))
+        r.pageno = parity
+        states[r.get_flow_state()] = (parity, r.get_song_state())
+
+    counter = PageCounter(stylesheet, options.pagesize)
+    counter.disable_compact = options.disable_compact
+
+    r = make_renderer(options, stylesheet, knownchords,
+        make_canvas(options, output, options.stream))
+
+    import multiprocessing
+    pool = multiprocessing.Pool(options.jobs,
+        _init_render_worker, (options,))
+    try:
+        # the songs parsed and not drawn yet: (filename, tokens, state,
+        # cached pages, pending result of the pool)
+        window = deque()
+        replayable = True
+        for fn, tokens in songs:
+            try:
+                tokens = list(tokens)
+            except ChoProParser.ParseError, e:
+                logger.error("error parsing file '%s': %s", fn, e)
+                return 1
+
+            parity, state = states.get(counter.get_flow_state(),
+                (None, None))
+            counter.new_song(fn)
+            for token in tokens:
+                counter.handle_token(token)
+            counter.end_song()
+
+            song = result = None
+            if state is not None and page_cache is not None:
+                song = page_cache.load(page_cache.get_key(tokens, state))
+            if state is not None and song is None and replayable:
+                result = pool.apply_async(_render_fragment,
+                    ((fn, tokens, parity),))
+            window.append((fn, tokens, state, song, result))
+
+            while len(window) > 4 * options.jobs:
+                if not _replay_fragment(r, page_cache, *window.popleft()):
+                    # e.g. TrueType fonts: draw the next songs in order
+                    replayable = False
+
+        while window:
+            _replay_fragment(r, page_cache, *window.popleft())
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    r.place_chord_boxes()
     r.end_of_input()
 
 
+def _replay_fragment(renderer, page_cache, fn, tokens, state, song, result):
+    """Draw a song in the output document, from its pages drawn in the pool.
+
+    The song is drawn again if its pages are missing or drawn in another
+    state. Return False if the pages drawn in the pool can't be replayed.
+    """
+    if result is not None:
+        song = result.get()
+        if song is not None and page_cache is not None:
+            page_cache.save(page_cache.get_key(tokens, state), song)
+
+    if song is not None and renderer.get_song_state() == state:
+        renderer.replay_song(fn, song)
+    elif page_cache is not None:
+        render_cached(renderer, page_cache, fn, tokens)
+    else:
+        renderer.new_song(fn)
+        for token in tokens:
+            renderer.handle_token(token)
+        renderer.end_song()
+
+    return result is None or song is not None
+
+
+# The objects used by a rendering worker process
+_render_worker = {}
+
+# Pages drawn on a worker canvas before replacing it
+_render_worker_pages = 500
+
+def _init_render_worker(options):
+    _render_worker['options'] = options
+    _render_worker['stylesheet'] = get_stylesheet(options)
+    _render_worker['knownchords'] = get_knownchords(options)
+    _render_worker['canvas'] = make_canvas(options, os.devnull)
+
+def _render_fragment(args):
+    """Draw a song in a worker, after a number of pages of some parity.
+
+    Return the pages, or None if they can't be replayed in another document.
+    """
+    fn, tokens, parity = args
+    w = _render_worker
+
+    # Reuse the canvas, so that the chord forms are only drawn once, but
+    # don't keep all the pages in memory.
+    canvas = w['canvas']
+    if canvas.getPageNumber() > _render_worker_pages:
+        canvas = w['canvas'] = make_canvas(w['options'], os.devnull)
+    else:
+        canvas.showPage()
+
+    r = make_renderer(w['options'], w['stylesheet'], w['knownchords'],
+        canvas)
+    r.pageno = parity
+    r.start_recording()
+    r.new_song(fn)
+    for token in tokens:
+        r.handle_token(token)
+    return r.stop_recording()
+
+
+def get_page_cache(options):
+    """Return the `PageCache` in the cache directory, if any."""
+    if options.cache_dir:
+        from .cache import PageCache
+        return PageCache(options.cache_dir,
+            max_size=options.cache_size * 1024 * 1024)
+
+
+def get_stylesheet(options):
+    """Return the `StyleSheet` to use according to the options."""
+    stylesheet = style.get_base_stylesheet()
+    if options.styles:
+        stylesheet.read(*options.styles)
+    return stylesheet
+
+
+def get_knownchords(options):
+    """Return the `ChordLibrary` for the instrument in the options.
+
+    The voicings generated are saved in the cache directory, if any.
+    """
+    knownchords = ChordDatabase.open(options.instrument)
+    if knownchords is None:
+        knownchords = {}
+
+    if options.cache_dir:
+        path = os.path.join(options.cache_dir,
+            'voicings-%s.dat' % options.instrument)
+    else:
+        path = None
+
+    return ChordLibrary(knownchords,
+        VoicingGenerator(options.instrument, path=path))
+
+
+def auto_transpose(fn, tokens, chooser, capo):
+    """Transpose the tokens of a file to the key easiest to play.
+
+    If `capo` is set, keep the key but choose a capo position: the chords
+    are transposed down and a comment with the capo is added.
+    """
+    tokens = list(tokens)
+    chords = [c for t in tokens if isinstance(t, chopro.Line)
+        for c in t.chords]
+    if capo:
+        shift = chooser.best_shift(chords, range(0, -8, -1))
+        if shift:
+            logger.info("%s: capo %d", fn, -shift)
+    else:
+        shift = chooser.best_shift(chords, range(-5, 7))
+        if shift:
+            logger.info("%s: transposed %+d", fn, shift)
+
+    xp = Transposer()
+    xp.guess_key(tokens)
+    for token in tokens:
+        if capo and shift and isinstance(token, chopro.Line):
+            yield chopro.Comment(u'Capo %d' % -shift)
+            capo = False
+        yield xpose(token, shift, xp)
+
+
+def iter_songs(fp, filenames, jobs):
+    """Generate (filename, tokens) pairs from the source files."""
+    if jobs > 1:
+        return parallel_parse(fp, filenames, jobs)
+    else:
+        return ((fn, fp.tokens(fn)) for fn in filenames)
+
+
+def get_output_name(output, shift):
+    """Return the name of the output file for a transposition."""
+    base, ext = os.path.splitext(output)
+    return "%s%+d%s" % (base, shift, ext)
+
+
+class FileParser(object):
+    """Parse and transpose the source files according to the options.
+
+    Instances can be sent to worker processes: calling them returns the
+    list of tokens of a file and the parse error message, if any.
+    """
+    def __init__(self, options, shift):
+        self.parser = ChoProParser(default_encoding='utf8')
+        self.shift = shift
+        if options.cache_dir:
+            from .cache import TokenCache
+            self.cache = TokenCache(options.cache_dir,
+                max_size=options.cache_size * 1024 * 1024)
+        else:
+            self.cache = None
+
+    def tokens(self, fn):
+        """Generate the tokens of a file."""
+        if self.cache is not None:
+            tokens = self.cache.parse_file(self.parser, fn)
+        else:
+            tokens = self.parser.parse_file(fn)
+
+        transposer = Transposer()
+        if self.shift:
+            tokens = list(tokens)
+            transposer.guess_key(tokens)
+        for token in tokens:
+            yield xpose(token, self.shift, transposer)
+
+    def __call__(self, fn):
+        rv = []
+        try:
+            for token in self.tokens(fn):
+                rv.append(token)
+        except ChoProParser.ParseError, e:
+            # nested exception classes can't be pickled
+            return rv, str(e)
+        return rv, None
+
+
+def parallel_parse(fp, filenames, jobs):
+    """Parse files in a pool of processes.
+
+    Generate (filename, tokens) pairs in the same order of the input. Only
+    a few files ahead of the one consumed are parsed, so that memory use
+    doesn't depend on the number of files.
+    """
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    try:
+        pending = deque()
+        for fn in filenames:
+            pending.append((fn, pool.apply_async(fp, (fn,))))
+            if len(pending) >= 2 * jobs:
+                fn, res = pending.popleft()
+                yield fn, _replay(*res.get())
+
+        while pending:
+            fn, res = pending.popleft()
+            yield fn, _replay(*res.get())
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _replay(tokens, error):
+    for token in tokens:
+        yield token
+    if error is not None:
+        raise ChoProParser.ParseError(error)
+
+
 def get_unit_factor(name, default=1):
     from reportlab.lib.units import toLength
     if name:
@@ -104,11 +494,20 @@ def check_page_size(option, opt, value):
         raise OptionValueError("option %s: invalid page size: %r"
                                % (opt, value))
 
+def check_shifts(option, opt, value):
+    try:
+        return [int(x) for x in value.split(',')]
+    except ValueError:
+        raise OptionValueError("option %s: invalid list of integers: %r"
+                               % (opt, value))
+
 class MyOption(Option):
-    """Option class with common option support and an added pagesize type"""
-    TYPES = Option.TYPES + ("pagesize",)
+    """Option class with common option support and added pagesize and
+    shifts types"""
+    TYPES = Option.TYPES + ("pagesize", "shifts")
     TYPE_CHECKER = copy(Option.TYPE_CHECKER)
     TYPE_CHECKER["pagesize"] = check_page_size
+    TYPE_CHECKER["shifts"] = check_shifts
 
 
 description = """Takes a set of chopro files and converts them to a single
@@ -124,13 +523,29 @@ def make_option_parser():
                        option_class=MyOption)
     opt.add_option("-o", "--output", dest="output", default="chords.pdf",
                    help="output file to write [default: %default]", metavar="FILE")
-    opt.add_option("--ukulele", action="store_true",
-                   help="print ukulele chords instead of guitar")
-    opt.add_option("--xpose", metavar="N", type=int,
-                   help="transpose the song N semitones")
+    opt.add_option("--instrument", choices=sorted(tunings), default="guitar",
+                   help="print chords for this instrument, one of: %s "
+                        "[default: %%default]" % ', '.join(sorted(tunings)))
+    opt.add_option("--ukulele", action="store_const", dest="instrument",
+                   const="ukulele", help="print ukulele chords instead of guitar")
+    opt.add_option("--xpose", metavar="N[,N...]", type="shifts",
+                   help="transpose the song N semitones; with more values "
+                        "write a file for each, adding N to its name")
+    opt.add_option("--auto-key", action="store_true",
+                   help="transpose each song to the key with most open chords")
+    opt.add_option("--best-capo", action="store_true",
+                   help="choose a capo position for each song to play the "
+                        "most open chords")
     opt.add_option("-p", "--pagesize", dest="pagesize", type="pagesize",
                    default="A4", metavar="SZ",
                    help="output page size, name or dimensions [default: %default]")
+    opt.add_option("--fit", action="store_true",
+                   help="choose the columns and the font size of each song "
+                        "to print it on the fewest pages")
+    opt.add_option("--fit-min-scale", metavar="PERCENT", type=int,
+                   default=70,
+                   help="smallest font size for --fit, in percent of the "
+                        "style [default: %default]")
     opt.add_option("--style", dest="styles", action="append",
                    help="use this style sheet (can be used more than once)")
     opt.add_option("--title", dest="doctitle", metavar="TITLE",
@@ -140,6 +555,18 @@ def make_option_parser():
     opt.add_option("--showfilenames",
                    action="store_true", dest="showfiles", default=False,
                    help="Show source filenames in output")
+    opt.add_option("-j", "--jobs", metavar="N", type=int, default=1,
+                   help="parse and render the files using N processes "
+                        "[default: %default]")
+    opt.add_option("--cache-dir", metavar="DIR",
+                   help="cache the parsed files and the rendered pages "
+                        "in this directory")
+    opt.add_option("--cache-size", metavar="MB", type=int, default=100,
+                   help="maximum size of the entries in the cache "
+                        "directory [default: %default]")
+    opt.add_option("--stream", action="store_true", default=False,
+                   help="write the pages to the output as soon as they are "
+                        "complete, to use less memory on large songbooks")
     opt.add_option("--no-compact",
                    action="store_true", dest="disable_compact", default=False,
                    help="Make place for chords even on lines w/o chords")
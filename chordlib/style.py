@@ -5,6 +5,7 @@ This file is part of chordlab.
 """
 
 import re
+import hashlib
 import pkgutil
 import ConfigParser
 from cStringIO import StringIO
@@ -23,17 +24,77 @@ def get_base_stylesheet():
 
 
 class StyleSheet(object):
+    """A set of `Style` objects compiled from a configuration.
+
+    Every section is resolved into an immutable `Style` as soon as the
+    configuration is loaded or extended by `read()`, so that bad values are
+    reported upfront and style lookups during rendering are cheap.
+    """
     def __init__(self, config):
         self.config = config
+        self.compile()
 
     def __getitem__(self, item):
-        return Style(self.config, item)
+        try:
+            return self._styles[item]
+        except KeyError:
+            raise ChordLibError("no style section '%s'" % item)
 
     def read(self, *files):
         out = self.config.read(files)
         if list(out) != list(files):
             raise ChordLibError("stylesheet not found: %s"
                 % ', '.join(sorted(set(files) - set(out))))
+        self.compile()
+
+    def get_digest(self):
+        """Return a string identifying the configuration of the styles."""
+        return self._digest
+
+    def scaled(self, factor):
+        """Return a stylesheet with the text of the songs scaled by a factor.
+
+        The styles of the other sections are shared with this stylesheet.
+        """
+        try:
+            return self._scaled[factor]
+        except KeyError:
+            pass
+
+        rv = StyleSheet.__new__(StyleSheet)
+        rv.config = self.config
+        rv._digest = hashlib.sha1(
+            '%s:%r' % (self._digest, factor)).hexdigest()
+        rv._styles = dict(self._styles)
+        for s in text_sections:
+            if s in rv._styles:
+                rv._styles[s] = rv._styles[s].scaled(factor)
+        rv._scaled = {}
+
+        self._scaled[factor] = rv
+        return rv
+
+    def compile(self):
+        """Resolve all the sections of the configuration into styles."""
+        h = hashlib.sha1()
+        for s in sorted(self.config.sections()):
+            h.update(repr((s, sorted(self.config.items(s, raw=True)))))
+        self._digest = h.hexdigest()
+
+        sections = set(self.config.sections())
+        sections.update(
+            s for s in sect_hierarchy if self._has_ancestor(s, sections))
+        self._styles = dict(
+            (s, Style(_SectionParser(self.config, s))) for s in sections)
+        self._scaled = {}
+
+    def _has_ancestor(self, sect, sections):
+        while sect:
+            if sect in sections:
+                return True
+            sect = sect_hierarchy.get(sect)
+        return False
+
 
 sect_hierarchy = {
     'title': 'songsheet',
@@ -47,111 +108,128 @@ sect_hierarchy = {
     'blank': 'songsheet',
 }
 
-class Style(object):
-    def __init__(self, config, item):
-        self.config = config
-        self.item = item
-
-    @property
-    def display(self):
-        return self._parse_bool('display')
-
-    @property
-    def ttfont(self):
-        return self._parse('font')
-
-    @property
-    def font_weight(self):
-        return self._parse_choices('font-weight', ['normal', 'bold'])
-
-    @property
-    def font_style(self):
-        return self._parse_choices('font-style', ['normal', 'italic'])
-
-    @property
-    def font(self):
-        font = self.ttfont
-        bold = self.font_weight == 'bold'
-        italic = self.font_style == 'italic'
-        return tt2ps(font, bold, italic)
-
-    @property
-    def font_path(self):
-        try:
-            return self._parse('font-path')
-        except ChordLibError:
-            return None
-
-
-    @property
-    def font_size(self):
-        return self._parse_int('font-size')
-
-    @property
-    def line_height(self):
-        return self._parse_int('line-height')
-
-    @property
-    def rise(self):
-        return self._parse_int('rise')
-
-    @property
-    def indent(self):
-        return self._parse_int('indent')
+# the sections of the song text, scaled by `StyleSheet.scaled()`
+text_sections = ('title', 'subtitle', 'comment', 'line', 'chord', 'tab',
+    'blank')
 
-    @property
-    def color(self):
-        return self._parse_color('color')
+class Style(object):
+    """The compiled, read-only properties of a style section.
 
+    A property not defined in the section nor in any of its ancestors is
+    only reported as an error if accessed.
+    """
     LEFT = 'left'
     RIGHT = 'right'
     CENTER = 'center'
 
-    @property
-    def align(self):
-        return self._parse_choices('align',
-            [self.LEFT, self.RIGHT, self.CENTER])
-
-    @property
-    def scale(self):
-        return self._parse_percent('scale')
+    # attribute name, option name, parsing method
+    properties = [
+        ('display', 'display', '_parse_bool'),
+        ('ttfont', 'font', '_parse'),
+        ('font_weight', 'font-weight', '_parse_font_weight'),
+        ('font_style', 'font-style', '_parse_font_style'),
+        ('font_size', 'font-size', '_parse_int'),
+        ('line_height', 'line-height', '_parse_int'),
+        ('rise', 'rise', '_parse_int'),
+        ('indent', 'indent', '_parse_int'),
+        ('color', 'color', '_parse_color'),
+        ('align', 'align', '_parse_align'),
+        ('scale', 'scale', '_parse_percent'),
+        ('duplex', 'duplex', '_parse_bool'),
+        ('margin_top', 'margin-top', '_parse_float'),
+        ('margin_bottom', 'margin-bottom', '_parse_float'),
+        ('margin_left', 'margin-left', '_parse_float'),
+        ('margin_right', 'margin-right', '_parse_float'),
+        ('margin_gutter', 'margin-gutter', '_parse_float'),
+    ]
+
+    __slots__ = ['item', 'font', 'font_path', '_missing'] \
+        + [p[0] for p in properties]
+
+    # the properties changed by `scaled()`
+    scaled_properties = ('font_size', 'line_height', 'rise', 'indent')
+
+    def __init__(self, parser):
+        setattr_ = super(Style, self).__setattr__
+        missing = {}
+        setattr_('item', parser.item)
+        setattr_('_missing', missing)
+
+        for attr, opt, meth in self.properties:
+            try:
+                setattr_(attr, getattr(parser, meth)(opt))
+            except _MissingOption, e:
+                missing[attr] = str(e)
 
-    @property
-    def duplex(self):
-        return self._parse_bool('duplex')
+        try:
+            setattr_('font_path', parser._parse('font-path'))
+        except _MissingOption:
+            setattr_('font_path', None)
 
-    @property
-    def margin_top(self):
-        return self._parse_float('margin-top')
+        try:
+            setattr_('font', tt2ps(self.ttfont,
+                self.font_weight == 'bold', self.font_style == 'italic'))
+        except ChordLibError, e:
+            missing['font'] = str(e)
+        except ValueError, e:
+            # not a standard font: it is only a problem if not a ttf
+            if self.font_path is None:
+                raise ChordLibError(
+                    "bad font in section '%s': %s" % (self.item, e))
+            missing['font'] = str(e)
+
+    def __getattr__(self, attr):
+        # only called if the slot is empty
+        try:
+            msg = self._missing[attr]
+        except KeyError:
+            raise AttributeError(attr)
+        raise ChordLibError(msg)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("styles are read-only")
+
+    def __repr__(self):
+        return "<Style %s>" % self.item
+
+    def scaled(self, factor):
+        """Return a copy of the style with the text size scaled."""
+        rv = Style.__new__(Style)
+        setattr_ = super(Style, rv).__setattr__
+        for attr in self.__slots__:
+            try:
+                value = getattr(self, attr)
+            except (AttributeError, ChordLibError):
+                # missing option, reported if accessed in the copy too
+                continue
+            if attr in self.scaled_properties:
+                value *= factor
+            setattr_(attr, value)
 
-    @property
-    def margin_bottom(self):
-        return self._parse_float('margin-bottom')
+        return rv
 
-    @property
-    def margin_left(self):
-        return self._parse_float('margin-left')
 
-    @property
-    def margin_right(self):
-        return self._parse_float('margin-right')
+class _MissingOption(ChordLibError):
+    pass
 
-    @property
-    def margin_gutter(self):
-        return self._parse_float('margin-gutter')
+class _SectionParser(object):
+    """Parse the options of a config section into python values."""
+    def __init__(self, config, item):
+        self.config = config
+        self.item = item
 
     def _parse(self, opt):
         sect = self.item
         while sect:
             try:
                 return self.config.get(sect, opt)
-            except ConfigParser.NoOptionError:
+            except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
                 # option not found: maybe specified in an ancestor?
                 sect = sect_hierarchy.get(sect)
             except ConfigParser.Error, e:
                 raise ChordLibError(str(e))
         else:
-            raise ChordLibError(
+            raise _MissingOption(
                 "no option '%s' in section '%s' or above"
                 % (opt, self.item))
 
@@ -205,6 +283,16 @@ class Style(object):
                 "bad value for '%s' in section %s: %s"
                     % (opt, self.item, val))
 
+    def _parse_font_weight(self, opt):
+        return self._parse_choices(opt, ['normal', 'bold'])
+
+    def _parse_font_style(self, opt):
+        return self._parse_choices(opt, ['normal', 'italic'])
+
+    def _parse_align(self, opt):
+        return self._parse_choices(opt,
+            [Style.LEFT, Style.RIGHT, Style.CENTER])
+
     def _parse_percent(self, opt):
         val = self._parse(opt)
         try:
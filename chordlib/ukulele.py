@@ -214,9 +214,3 @@ knownchords.update({
     'Gb7sus4': [6, 1, 1, 2, 2],
     'Gbmaj7': [2, 2, 4, 1, 3],
 })
-
-# add the #'s
-shmap = dict(('DC', 'ED', 'GF', 'AG', 'BA'))
-for chord in knownchords.keys():
-    if chord[0] in shmap and chord[1:2] == 'b':
-        knownchords[shmap[chord[0]] + '#' + chord[2:]] = knownchords[chord]
@@ -0,0 +1,310 @@
+"""
+Generation of chord voicings for fretted instruments.
+
+This file is part of chordlab.
+"""
+
+import os
+import marshal
+import hashlib
+import tempfile
+
+from .cache import get_file_mode
+from .chords import ChordIndex, chord_symbol
+
+import logging
+logger = logging.getLogger('chordlib.voicing')
+
+# Strings pitch classes (A = 0), from the lowest, and whether the lowest
+# string plays the bass of the chord (not in reentrant tunings, nor in the
+# mandolin charts).
+tunings = {
+    'guitar': ([7, 0, 5, 10, 2, 7], True),          # E A D G B E
+    'drop-d': ([5, 0, 5, 10, 2, 7], True),          # D A D G B E
+    'ukulele': ([10, 3, 7, 0], False),              # G C E A
+    'baritone': ([5, 10, 2, 7], True),              # D G B E
+    'mandolin': ([10, 5, 0, 7], False),             # G D A E
+    'bass': ([7, 0, 5, 10], True),                  # E A D G
+}
+
+# Chord formulas: semitones from the root. The intervals in `optional` can
+# be dropped if there are not enough strings or to make a chord easier.
+formulas = {
+    '': (0, 4, 7),
+    'm': (0, 3, 7),
+    '5': (0, 7),
+    'dim': (0, 3, 6),
+    'aug': (0, 4, 8),
+    'sus2': (0, 2, 7),
+    'sus4': (0, 5, 7),
+    '6': (0, 4, 7, 9),
+    'm6': (0, 3, 7, 9),
+    '7': (0, 4, 7, 10),
+    'maj7': (0, 4, 7, 11),
+    'm7': (0, 3, 7, 10),
+    'mmaj7': (0, 3, 7, 11),
+    'm7b5': (0, 3, 6, 10),
+    'dim7': (0, 3, 6, 9),
+    '7sus4': (0, 5, 7, 10),
+    '7sus2': (0, 2, 7, 10),
+    'add9': (0, 4, 7, 2),
+    'madd9': (0, 3, 7, 2),
+    '6/9': (0, 4, 7, 9, 2),
+    '7b9': (0, 4, 7, 10, 1),
+    '7#9': (0, 4, 7, 10, 3),
+    '7b5': (0, 4, 6, 10),
+    '7#5': (0, 4, 8, 10),
+    '9': (0, 4, 7, 10, 2),
+    'maj9': (0, 4, 7, 11, 2),
+    'm9': (0, 3, 7, 10, 2),
+    '11': (0, 4, 7, 10, 2, 5),
+    'm11': (0, 3, 7, 10, 2, 5),
+    '13': (0, 4, 7, 10, 2, 5, 9),
+}
+
+optional = (7, 2, 5)
+
+# frets spanned by a hand position
+span = 4
+
+# Bump when the search changes, to drop the voicings saved in files
+format_version = 2
+
+
+class VoicingGenerator(object):
+    """Find playable voicings for chords on a tuning.
+
+    All the fingerings within a hand position along the neck are searched,
+    ranked by frets span, position, open and muted strings and barre cost.
+    Results are memoized and can be persisted in a file.
+    """
+    def __init__(self, tuning, path=None):
+        self.tuning = tuning
+        self.strings, self.check_bass = tunings[tuning]
+        self.path = path
+        self._voicings = {}
+        self._dirty = False
+        if path is not None:
+            self._load()
+
+    def get_voicing(self, name):
+        """Return a chord voicing as [base fret, fret, ...] or None.
+
+        Frets are relative to the base fret, 0 for open and None for muted
+        strings, as in the `knownchords` tables.
+        """
+        try:
+            return self._voicings[name]
+        except KeyError:
+            pass
+
+        rv = self._voicings[name] = self._search(name)
+        self._dirty = True
+        return rv
+
+    def get_config(self):
+        """Return a marshallable value identifying the voicings found."""
+        return (format_version, tuple(self.strings), self.check_bass)
+
+    def save(self):
+        """Store the voicings found in the file, if any."""
+        if self.path is None or not self._dirty:
+            return
+
+        dirname = os.path.dirname(self.path) or '.'
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=dirname)
+        try:
+            try:
+                os.write(fd, marshal.dumps(
+                    (self.get_config(), self._voicings)))
+            finally:
+                os.close(fd)
+            os.chmod(tmp, get_file_mode())
+            os.rename(tmp, self.path)
+        except OSError, e:
+            logger.warn("can't write voicings file: %s", e)
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+        else:
+            self._dirty = False
+
+    def _load(self):
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return
+
+        try:
+            try:
+                data = marshal.loads(f.read())
+            finally:
+                f.close()
+        except Exception, e:
+            logger.warn("bad voicings file %s: %s", self.path, e)
+            return
+
+        # saved by a different version or tuning: search again
+        if isinstance(data, tuple) and data[0] == self.get_config():
+            self._voicings.update(data[1])
+
+            # mark the file as recently used for the cache eviction
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                pass
+
+    def _search(self, name):
+        # the spellings of a chord share the canonical suffix
+        canonical = chord_symbol(name).canonical
+        if canonical is None:
+            return None
+        root, suffix, bass = canonical
+        try:
+            formula = formulas[suffix]
+        except KeyError:
+            return None
+
+        if bass is None:
+            bass = root
+
+        tones = set((root + i) % 12 for i in formula)
+        required = set((root + i) % 12 for i in formula
+            if not (i in optional and len(formula) > 3))
+        tones.add(bass)
+        required.add(bass)
+        if len(required) > len(self.strings):
+            return None
+
+        best = None
+        for lo in range(1, 13):
+            for frets in self._fingerings(tones, lo):
+                cost = self._get_cost(frets, required, bass)
+                if cost is not None and (best is None or cost < best[0]):
+                    best = (cost, frets)
+
+        if best is None:
+            return None
+
+        frets = best[1]
+        fretted = [f for f in frets if f]
+        if not fretted or max(fretted) <= span:
+            base_fret = 1
+        else:
+            base_fret = min(fretted)
+        return [base_fret] + [
+            f if not f else f - base_fret + 1 for f in frets]
+
+    def _fingerings(self, tones, lo):
+        """Generate the fingerings of the tones in the position `lo`.
+
+        Muted strings are only allowed on the bass side.
+        """
+        nstrings = len(self.strings)
+        maxmuted = nstrings - 4
+        cands = []
+        for pc in self.strings:
+            cand = []
+            if pc in tones:
+                cand.append(0)
+            for f in range(lo, lo + span):
+                if (pc + f) % 12 in tones:
+                    cand.append(f)
+            cands.append(cand)
+
+        def search(i, muting):
+            if i == nstrings:
+                yield []
+                return
+            if muting and i < maxmuted:
+                for rest in search(i + 1, True):
+                    yield [None] + rest
+            for f in cands[i]:
+                for rest in search(i + 1, False):
+                    yield [f] + rest
+
+        return search(0, True)
+
+    def _get_cost(self, frets, required, bass):
+        played = [(pc + f) % 12 for pc, f in zip(self.strings, frets)
+            if f is not None]
+        if len(played) < 3 or not required.issubset(played):
+            return None
+        if self.check_bass and played[0] != bass:
+            return None
+
+        fretted = [f for f in frets if f]
+        if fretted:
+            minf = min(fretted)
+            barre = fretted.count(minf) > 1
+            if barre:
+                # a barre can't leave open strings below it
+                first = frets.index(minf)
+                last = len(frets) - frets[::-1].index(minf)
+                barre = 0 not in frets[first:last]
+            fingers = len(fretted) - (fretted.count(minf) - 1 if barre else 0)
+            if fingers > 4:
+                return None
+            cost = 2 * (max(fretted) - minf) + minf + fingers + 2 * barre
+        else:
+            cost = 0
+
+        cost += 2 * frets.count(None) - frets.count(0)
+        return cost
+
+
+class ChordLibrary(object):
+    """Read-only mapping from chord names to voicings.
+
+    Voicings are looked up in a table of known chords first, by any
+    spelling of the chord name, then asked to a `VoicingGenerator`. The
+    index of the spellings is only built when a name is not found as it
+    is, so that the names of a database file are not all read.
+    """
+    def __init__(self, knownchords, generator=None):
+        self.knownchords = knownchords
+        self.generator = generator
+        self._index = None
+        self._digest = None
+
+    def get(self, name, default=None):
+        rv = self.knownchords.get(name)
+        if rv is None:
+            if self._index is None:
+                self._index = ChordIndex(self.knownchords.keys())
+            rv = self._index.lookup(self.knownchords, name)
+        if rv is not None:
+            return rv
+        if self.generator is not None:
+            rv = self.generator.get_voicing(name)
+            if rv is not None:
+                return rv
+        return default
+
+    def __getitem__(self, name):
+        rv = self.get(name)
+        if rv is None:
+            raise KeyError(name)
+        return rv
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def get_digest(self):
+        """Return a string identifying the voicings of the library."""
+        if self._digest is None:
+            h = hashlib.sha1()
+            if self.generator is not None:
+                h.update(repr(self.generator.get_config()) + '\0')
+            if hasattr(self.knownchords, 'get_digest'):
+                h.update(self.knownchords.get_digest())
+            else:
+                h.update(repr(sorted(self.knownchords.iteritems())))
+            self._digest = h.hexdigest()
+
+        return self._digest
+
+    def iteritems(self):
+        """Iterate on the known chords (not on the generated ones)."""
+        return self.knownchords.iteritems()
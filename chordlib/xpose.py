@@ -5,47 +5,277 @@ This file is part of chordlab.
 """
 
 from . import chopro
+from .chords import ChordSymbol, chord_symbol, no_chords
+from .chords import sharp_names, flat_names, positions
 
 import logging
 logger = logging.getLogger('chordlib.script')
 
-def xpose(token, shift):
+def xpose(token, shift, transposer=None):
+    """Transpose a token by `shift` semitones.
+
+    Pass the same `Transposer` for all the tokens of a document to choose
+    the chords spelling according to the key and to reuse its tables.
+    """
     if not shift:
         return token
-    if  isinstance(token, chopro.Define):
-        logger.warn("can't shift a define yet")
+    if transposer is None:
+        transposer = Transposer()
+    if isinstance(token, chopro.Define):
+        return transposer.shift_define(token, shift)
     if not isinstance(token, chopro.Line):
         return token
 
-    parts = []
-    for i, x in enumerate(token.arg):
-        if i % 2 == 0:
-            parts.append(x)
-        else:
-            parts.append(shift_chord(x, shift))
+    parts = token.arg
+    for i, chord in enumerate(token.chords):
+        parts[i * 2 + 1] = transposer.shift(chord, shift).name
 
     return chopro.Line(parts)
 
 
 def shift_chord(chord, shift):
-    if shift == 0:
-        return chord
+    """Transpose a chord by `shift` semitones.
+
+    `chord` can be a `ChordSymbol` or a name: return the same type.
+    """
+    if not isinstance(chord, ChordSymbol):
+        return shift_chord(chord_symbol(chord), shift).name
+
+    return Transposer().shift(chord, shift)
+
+
+class Transposer(object):
+    """Transpose the chords of a document.
+
+    The first time a chord is seen, its transposition in all the 12 keys is
+    computed and stored in a table. Both the root and the bass note of the
+    chords are shifted.
+
+    Sharps or flats are used in the transposed chords according to the
+    target key. The key of the document is set by `guess_key()` from all
+    its chords; if not called, the key of the first chord of its lines is
+    used. The chords defined before the key is known are spelled with
+    sharps.
+    """
+    def __init__(self):
+        self.key = None
+        self._table = {}
+        self._defines = {}
+
+    def guess_key(self, tokens):
+        """Guess the key of the document from the chords of its lines.
+
+        The key chosen is the major key having most chords of the song
+        among its triads, e.g. C, Dm, Em, F, G, Am and Bdim for C major. On
+        equal count the key of the first chord wins.
+        """
+        counts = {}
+        first = None
+        for token in tokens:
+            if not isinstance(token, chopro.Line):
+                continue
+            for chord in token.chords:
+                if chord.note not in positions:
+                    continue
+                if first is None:
+                    first = _chord_key(chord)
+                triad = (positions[chord.note], _triad_quality(chord))
+                counts[triad] = counts.get(triad, 0) + 1
+
+        if first is None:
+            return
+
+        def score(key):
+            return sum(n for (root, quality), n in counts.iteritems()
+                if _diatonic.get((root - key) % 12) == quality)
+
+        self.key = max(range(12), key=lambda k: (score(k), k == first))
+
+    def shift(self, chord, shift):
+        """Return the `ChordSymbol` of a chord transposed `shift` semitones."""
+        try:
+            return self._table[chord][shift % 12]
+        except KeyError:
+            pass
+
+        if self.key is None and chord.note in positions:
+            self.key = _chord_key(chord)
+
+        row = self._table[chord] = self._make_row(chord)
+        return row[shift % 12]
+
+    def shift_define(self, token, shift):
+        """Return a `Define` token transposed `shift` semitones.
+
+        The chord is renamed as the chords in the song and the diagram is
+        moved along the neck, an octave up or down if needed.
+        """
+        key = (tuple(token.arg), shift)
+        try:
+            return self._defines[key]
+        except KeyError:
+            pass
+
+        args = token.arg
+        if len(args) < 5 or args[1] != 'base-fret' or args[3] != 'frets':
+            # let the renderer complain
+            rv = token
+        else:
+            chord = chord_symbol(args[0])
+            if self.key is None:
+                # don't guess the key from the definitions
+                name = self._make_row(chord)[shift % 12].name
+            else:
+                name = self.shift(chord, shift).name
+            try:
+                rv = chopro.Define.from_state(
+                    [name] + _shift_frets(int(args[2]), args[4:], shift))
+            except ValueError:
+                rv = token
+
+        if self.key is not None:
+            self._defines[key] = rv
+        return rv
+
+    def _make_row(self, chord):
+        if chord.note not in positions:
+            if chord.name.strip() not in no_chords:
+                logger.warn("can't shift chord: %s", chord.name)
+            return [chord] * 12
 
-    for l in (2,1):
-        if chord[:l] in positions:
-            shifted = invpos[(positions[chord[:l]] + shift) % 12]
-            return shifted + chord[l:]
+        rv = [chord]
+        for shift in range(1, 12):
+            if self.key is not None and (self.key + shift) % 12 in flat_keys:
+                names = flat_names
+            else:
+                names = sharp_names
+
+            # rebuild the name from its parts, e.g. 'D/F# (x2)'
+            name = chord.lead + names[(positions[chord.note] + shift) % 12] \
+                + chord.quality + chord.extensions
+            if chord.bass is not None:
+                name += '/' + names[(positions[chord.bass] + shift) % 12]
+            rv.append(chord_symbol(name + chord.trailer))
+
+        return rv
+
+
+def _chord_key(chord):
+    """Return the major key of a chord, the relative major for minors."""
+    if chord.quality in ('m', 'min'):
+        return (positions[chord.note] + 3) % 12
+    else:
+        return positions[chord.note]
+
+def _triad_quality(chord):
+    if chord.quality in ('m', 'min'):
+        return 'm'
+    elif chord.quality == 'dim':
+        return 'dim'
     else:
-        logger.warn("can't shift chord: %s", chord)
-        return chord
+        return ''
+
+# the quality of the triads of a major key, by semitones from the tonic
+_diatonic = {0: '', 2: 'm', 4: 'm', 5: '', 7: '', 9: 'm', 11: 'dim'}
+
+
+class KeyChooser(object):
+    """Choose the transposition making a song easier to play.
+
+    Each transposition is scored by how many chords of the song have an
+    open voicing (base fret 1) among `knownchords`.
+
+    For every chord shape (e.g. 'm7' or '/3rd') a 12 bits mask records the
+    roots having an open voicing; the mask of a song chord rotated by its
+    root tells the transpositions making the chord open, so all the keys
+    are scored at once without transposing anything.
+    """
+    def __init__(self, knownchords):
+        self.masks = {}
+        for name, frets in knownchords.iteritems():
+            if frets[0] != 1:
+                continue
+            chord = chord_symbol(name)
+            shape = self._get_shape(chord)
+            if shape is not None:
+                self.masks[shape] = self.masks.get(shape, 0) \
+                    | (1 << positions[chord.note])
 
+    def get_scores(self, chords):
+        """Return the scores of the 12 transpositions of a list of chords."""
+        counts = {}
+        for chord in chords:
+            counts[chord] = counts.get(chord, 0) + 1
 
-invpos = dict(enumerate('A A# B C C# D D# E F F# G G#'.split()))
-positions = dict((c, p) for (p, c) in invpos.iteritems())
+        rv = [0] * 12
+        for chord, n in counts.iteritems():
+            shape = self._get_shape(chord)
+            mask = self.masks.get(shape, 0)
+            if not mask:
+                continue
+            root = positions[chord.note]
+            mask = ((mask >> root) | (mask << (12 - root))) & 0xFFF
+            for shift in range(12):
+                if mask & (1 << shift):
+                    rv[shift] += n
+
+        return rv
+
+    def best_shift(self, chords, shifts):
+        """Return the best of `shifts` to play a list of chords.
+
+        On equal score prefer the shifts with the smallest magnitude.
+        """
+        scores = self.get_scores(chords)
+        return max(shifts, key=lambda s: (scores[s % 12], -abs(s)))
+
+    def _get_shape(self, chord):
+        chord = chord_symbol(chord.key)
+        if chord.note not in positions:
+            return None
+        if chord.bass is None:
+            return (chord.quality + chord.extensions, None)
+        if chord.bass not in positions:
+            return None
+        return (chord.quality + chord.extensions,
+            (positions[chord.bass] - positions[chord.note]) % 12)
+
+
+def _shift_frets(base_fret, frets, shift):
+    """Move a chord diagram `shift` frets along the neck.
+
+    Return the 'base-fret', N, 'frets', ... part of a chord definition.
+    """
+    muted = ('-', 'X', 'x')
+    rel = [None if f in muted else int(f) for f in frets]
+
+    if 0 not in rel:
+        # just move the diagram
+        base_fret += shift
+        if base_fret < 1:
+            base_fret += 12
+        elif base_fret > 12:
+            base_fret -= 12
+        return ['base-fret', str(base_fret), 'frets'] + list(frets)
+
+    # open strings must be fretted: work with the absolute frets
+    pos = [f and base_fret + f - 1 for f in rel]
+    pos = [p if p is None else p + shift for p in pos]
+    played = [p for p in pos if p is not None]
+    if min(played) < 0:
+        pos = [p if p is None else p + 12 for p in pos]
+    elif min(played) >= 12:
+        pos = [p if p is None else p - 12 for p in pos]
+
+    fretted = [p for p in pos if p]
+    if not fretted or max(fretted) <= 4:
+        base_fret = 1
+    else:
+        base_fret = min(fretted)
 
-shmap = dict(('CD', 'DE', 'FG', 'GA', 'AB'))
-for chord in positions.keys():
-    if chord[1:2] == '#':
-        positions[shmap[chord[0]] + 'b'] = positions[chord]
+    return ['base-fret', str(base_fret), 'frets'] + [
+        'x' if p is None else str(p and p - base_fret + 1) for p in pos]
 
 
+# major keys written with flats: F Bb Eb Ab Db
+flat_keys = frozenset(flat_names.index(n) for n in 'F Bb Eb Ab Db'.split())
@@ -0,0 +1,50 @@
+# coding: utf8
+"""
+Tests for the chord names parsing.
+
+This file is part of chordlab.
+"""
+
+import unittest
+
+from chordlib.chords import chord_symbol
+
+
+class CanonicalTestCase(unittest.TestCase):
+    # the spellings of the same chord, with its (root, suffix, bass) key
+    spellings = [
+        ((3, u'', None), [u'C', u'CM', u'Cmaj']),
+        ((3, u'm', None), [u'Cm', u'Cmin']),
+        ((3, u'maj7', None),
+            [u'Cmaj7', u'CM7', u'Cma7', u'Cj7', u'CΔ7', u'CΔ']),
+        ((3, u'maj9', None), [u'Cmaj9', u'CM9', u'Cma9']),
+        ((3, u'm7', None), [u'Cm7', u'Cmin7']),
+        ((3, u'madd9', None), [u'Cmadd9']),
+        ((3, u'mmaj7', None), [u'CmM7', u'Cmmaj7', u'CmΔ']),
+        ((3, u'aug', None), [u'Caug', u'C+']),
+        ((3, u'sus4', None), [u'Csus', u'Csus4']),
+        ((3, u'7sus4', None), [u'C7sus', u'C7sus4']),
+        ((4, u'maj7', None), [u'C#maj7', u'DbM7', u'DbΔ']),
+        ((2, u'7', None), [u'B7', u'H7']),
+        ((1, u'', None), [u'Bb', u'A#', u'Hb']),
+        ((3, u'', 7), [u'C/E', u'C/Fb']),
+    ]
+
+    def test_spellings(self):
+        for canonical, names in self.spellings:
+            for name in names:
+                self.assertEqual(chord_symbol(name).canonical, canonical,
+                    name)
+
+    def test_no_chord(self):
+        for name in [u'N.C.', u'%', u'-', u'']:
+            self.assertEqual(chord_symbol(name).canonical, None, name)
+
+    def test_minor_not_major(self):
+        self.assertEqual(chord_symbol(u'Cmadd9').quality, u'm')
+        self.assertEqual(chord_symbol(u'Cma7').quality, u'')
+        self.assertEqual(chord_symbol(u'Cmaj7').quality, u'')
+
+
+if __name__ == '__main__':
+    unittest.main()
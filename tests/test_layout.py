@@ -0,0 +1,142 @@
+# coding: utf8
+"""
+Tests for the layout of the songs.
+
+This file is part of chordlab.
+"""
+
+import os
+import random
+import unittest
+
+from reportlab.pdfgen.canvas import Canvas
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.lib.rl_accel import fp_str
+
+from chordlib import chopro
+from chordlib.layout import SongsLayout, FontRegistry, fill_count, \
+    font_registry
+from chordlib.style import get_base_stylesheet
+
+
+def loop_fill(textobj, char, end):
+    """Fill as the renderer used to: one glyph at a time up to `end`.
+
+    Return the number of glyphs drawn.
+    """
+    rv = 0
+    while textobj.getCursor()[0] < end:
+        textobj.textOut(char)
+        rv += 1
+    return rv
+
+
+class FillCountTestCase(unittest.TestCase):
+    fonts = [('Helvetica', 12), ('Times-Roman', 10), ('Courier', 8.5),
+        ('Helvetica-Bold', 7.7)]
+    chars = [u' ', u'·']
+
+    def check(self, x, end, char, font):
+        textobj = Canvas(os.devnull).beginText(x, 0)
+        textobj.setFont(*font)
+        n = loop_fill(textobj, char, end)
+        self.assertEqual(fill_count(x, end, stringWidth(char, *font)), n,
+            (x, end, char, font))
+
+        # the cursor after the fill, as written in the page
+        self.assertEqual(fp_str(x + stringWidth(char * n, *font)),
+            fp_str(textobj.getCursor()[0]))
+
+    def test_random(self):
+        rnd = random.Random(42)
+        for i in xrange(2000):
+            x = rnd.uniform(0, 500)
+            self.check(x, x + rnd.uniform(-5, 60), rnd.choice(self.chars),
+                rnd.choice(self.fonts))
+
+    def test_whole_glyphs(self):
+        # the end falls on a glyph boundary, up to the rounding errors
+        rnd = random.Random(42)
+        for i in xrange(2000):
+            char = rnd.choice(self.chars)
+            font = rnd.choice(self.fonts)
+            x = rnd.uniform(0, 500)
+            end = x + stringWidth(char, *font) * rnd.randint(1, 30)
+            self.check(x, end, char, font)
+
+    def test_no_width(self):
+        self.assertEqual(fill_count(10, 20, 0), 0)
+
+
+class FontRegistryTestCase(unittest.TestCase):
+    def test_shared(self):
+        # the same fonts in new stylesheets don't add entries
+        registry = FontRegistry()
+        stylesheet = get_base_stylesheet()
+        font = registry.get_font(stylesheet['line'])
+        size = len(registry._fonts)
+        for i in range(3):
+            stylesheet.compile()
+            self.assertEqual(registry.get_font(stylesheet['line']), font)
+            registry.get_font(stylesheet.scaled(1.0)['line'])
+        self.assertEqual(len(registry._fonts), size)
+
+        scaled = stylesheet.scaled(0.5)['line']
+        self.assertEqual(registry.get_font(scaled),
+            (font[0], scaled.font_size))
+
+
+class PlacePartsTestCase(unittest.TestCase):
+    def place(self, text):
+        layout = SongsLayout()
+        layout.new_song('test')
+        # the chords are unknown: don't warn
+        layout.use_chord = lambda chord: None
+        token = chopro.Line(chopro.ChoProParser.chord_re.split(text))
+        return layout, layout._place_parts(50, token.arg, token.chords,
+            False)
+
+    def test_fill(self):
+        text = u'[Cmaj7#11]a[Dm7b5/Ab]word [G13sus4]i[Ebdim7]s'
+        layout, (runs, xs, right) = self.place(text)
+
+        # draw the line as the renderer used to
+        fl = font_registry.get_font(layout.style['line'])
+        fc = font_registry.get_font(layout.style['chord'])
+        textobj = Canvas(os.devnull).beginText(50, 0)
+        parts = chopro.ChoProParser.chord_re.split(text)
+        fills = []
+        origins = []
+        okpos = 0
+        for i, part in enumerate(parts):
+            if i % 2:
+                csp = textobj.getCursor()
+                if i + 1 < len(parts) and (
+                        not parts[i + 1] or parts[i + 1].isspace()):
+                    cfill = u' '
+                else:
+                    cfill = u'·'
+                textobj.setFont(*fl)
+                fills.append(loop_fill(textobj, cfill, okpos))
+                csp = textobj.getCursor()
+                origins.append(fp_str(csp[0]))
+                textobj.setFont(*fc)
+                textobj.textOut(part)
+                okpos = textobj.getCursor()[0] + 3
+                textobj.setTextOrigin(*csp)
+            else:
+                textobj.setFont(*fl)
+                textobj.textOut(part)
+
+        # every chord but the first is longer than the lyrics before it
+        self.assertEqual(fills[0], 0)
+        self.assertTrue(all(fills[1:]), fills)
+        placed = [len(r[3]) for r in runs if r[1] == 'line'
+            and r[3] and r[3].strip(u' ·') == u'']
+        self.assertEqual(placed, [n for n in fills if n])
+        self.assertEqual([fp_str(r[0]) for r in runs if r[1] == 'chord'],
+            origins)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+"""
+Tests for the chords transposition.
+
+This file is part of chordlab.
+"""
+
+import unittest
+
+from chordlib import chopro
+from chordlib.chords import chord_symbol
+from chordlib.xpose import Transposer, xpose, _shift_frets
+
+
+class TransposerTestCase(unittest.TestCase):
+    def shift(self, names, shift):
+        xp = Transposer()
+        return [xp.shift(chord_symbol(n), shift).name for n in names]
+
+    def test_shift(self):
+        self.assertEqual(self.shift([u'C', u'Am7', u'G/B'], 2),
+            [u'D', u'Bm7', u'A/C#'])
+        self.assertEqual(self.shift([u'C', u'Am7', u'G/B'], -2),
+            [u'Bb', u'Gm7', u'F/A'])
+
+    def test_zero_shift(self):
+        self.assertEqual(self.shift([u'Db', u'F#m'], 12), [u'Db', u'F#m'])
+
+    def test_key_spelling(self):
+        # G to Ab: flats
+        self.assertEqual(self.shift([u'G', u'C', u'D7'], 1),
+            [u'Ab', u'Db', u'Eb7'])
+        # Em (key of G) to Fm (key of Ab): flats
+        self.assertEqual(self.shift([u'Em', u'C'], 1), [u'Fm', u'Db'])
+        # D to E: sharps
+        self.assertEqual(self.shift([u'D', u'Bb', u'A/C#'], 2),
+            [u'E', u'C', u'B/D#'])
+
+    def test_spaces(self):
+        self.assertEqual(self.shift([u'D/F# '], 2), [u'E/G# '])
+        self.assertEqual(self.shift([u' Am '], 2), [u' Bm '])
+
+    def test_trailer(self):
+        self.assertEqual(self.shift([u'D/F# (x2)'], 2), [u'E/G# (x2)'])
+        self.assertEqual(self.shift([u'C(add9)/E'], 2), [u'D(add9)/F#'])
+        self.assertEqual(self.shift([u'Bb7(b9)'], 2), [u'C7(b9)'])
+
+    def test_guess_key(self):
+        # in G, starting from the dominant: F# is a sharp key, Db a flat one
+        tokens = [chopro.Line([u'', u'D', u'la ', u'G']),
+            chopro.Line([u'', u'C', u'la ', u'Em', u'la ', u'D'])]
+        xp = Transposer()
+        xp.guess_key(tokens)
+        self.assertEqual([xpose(t, -1, xp).arg[1::2] for t in tokens],
+            [[u'C#', u'F#'], [u'B', u'D#m', u'C#']])
+
+        xp = Transposer()
+        self.assertEqual(xpose(tokens[0], -1, xp).arg[1::2],
+            [u'Db', u'Gb'])
+
+    def test_no_chord(self):
+        self.assertEqual(self.shift([u'N.C.', u'%'], 3), [u'N.C.', u'%'])
+
+    def test_define_key(self):
+        xp = Transposer()
+        define = chopro.Define(u'F base-fret 1 frets 1 3 3 2 1 1')
+        self.assertEqual(xpose(define, 5, xp).arg[0], u'A#')
+        self.assertEqual(xp.key, None)
+
+        line = xpose(chopro.Line([u'', u'F', u'la ', u'Bb']), 5, xp)
+        self.assertEqual(line.arg, [u'', u'Bb', u'la ', u'Eb'])
+        self.assertEqual(xpose(define, 5, xp).arg[0], u'Bb')
+
+
+class ShiftFretsTestCase(unittest.TestCase):
+    def test_no_open_strings(self):
+        self.assertEqual(_shift_frets(3, '1 3 3 2 1 1'.split(), 2),
+            ['base-fret', '5', 'frets', '1', '3', '3', '2', '1', '1'])
+
+    def test_wrap_base_fret(self):
+        self.assertEqual(_shift_frets(11, '1 3 3 2 1 1'.split(), 3),
+            ['base-fret', '2', 'frets', '1', '3', '3', '2', '1', '1'])
+        self.assertEqual(_shift_frets(1, '1 3 3 2 1 1'.split(), -2),
+            ['base-fret', '11', 'frets', '1', '3', '3', '2', '1', '1'])
+
+    def test_open_strings(self):
+        # C shape to D
+        self.assertEqual(_shift_frets(1, 'x 3 2 0 1 0'.split(), 2),
+            ['base-fret', '2', 'frets', 'x', '4', '3', '1', '2', '1'])
+        # E shape to A
+        self.assertEqual(_shift_frets(1, '0 2 2 1 0 0'.split(), 5),
+            ['base-fret', '5', 'frets', '1', '3', '3', '2', '1', '1'])
+
+    def test_open_strings_octave(self):
+        # D shape to B, up the neck
+        self.assertEqual(_shift_frets(1, 'x x 0 2 3 2'.split(), -3),
+            ['base-fret', '9', 'frets', 'x', 'x', '1', '3', '4', '3'])
+
+    def test_stay_open(self):
+        self.assertEqual(_shift_frets(1, 'x 0 2 2 2 0'.split(), 12),
+            ['base-fret', '1', 'frets', 'x', '0', '2', '2', '2', '0'])
+
+
+if __name__ == '__main__':
+    unittest.main()